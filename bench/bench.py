@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# Dedicated to the public domain under CC0: https://creativecommons.org/publicdomain/zero/1.0/.
+
+'''
+Coven tracing overhead benchmarks.
+Each workload in bench/workloads is run under the plain interpreter, and then under coven in each tracing mode,
+writing a trace file (so that report analysis is excluded from the measurement).
+The result for each (workload, mode) pair is the slowdown factor: the coven time divided by the plain time.
+Each time is the median CPU time (user plus system, from `wait4`) of `-repeat` runs,
+which is less affected by other load on the machine than wall time,
+and its noise is the spread of those runs (maximum minus minimum) relative to the median.
+Results can be written as JSON, and compared against a stored baseline;
+the exit status is 1 if any slowdown regressed by more than the `-tolerance` fraction plus the noise of the measurement
+(that of the plain time and the coven time), so that a noisy run does not report spurious regressions.
+'''
+
+import json
+import os
+import sys
+from argparse import ArgumentParser
+from statistics import median
+from subprocess import DEVNULL, Popen, run
+from tempfile import TemporaryDirectory
+
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+workloads_dir = os.path.join(bench_dir, 'workloads')
+coven_path = os.path.join(os.path.dirname(bench_dir), 'coven.py')
+default_baseline_path = os.path.join(bench_dir, 'baseline.json')
+
+# Maps mode names to coven arguments.
+modes = {
+  'sets': [],
+  'bits': ['-record', 'bits'],
+  'saturate': ['-saturate'],
+  'sample': ['-sample', '0.1'],
+  'sample-window': ['-sample', '0.05', '-sample-window', '0.01'],
+  'probes': ['-engine', 'probes'],
+  'lines': ['-lines'],
+}
+
+
+def main():
+  arg_parser = ArgumentParser(description='coven tracing overhead benchmarks.')
+  arg_parser.add_argument('-python', default=sys.executable, help='interpreter to benchmark with.')
+  arg_parser.add_argument('-workloads', nargs='+', help='workload names (default: all).')
+  arg_parser.add_argument('-modes', nargs='+', choices=modes, help='tracing modes (default: all).')
+  arg_parser.add_argument('-scale', type=int, default=1, help='workload size multiplier.')
+  arg_parser.add_argument('-repeat', type=int, default=7, help='runs per measurement; the median time is used.')
+  arg_parser.add_argument('-json', metavar='PATH', help='write results as JSON to PATH ("-" for stdout).')
+  arg_parser.add_argument('-baseline', nargs='?', const=default_baseline_path, metavar='PATH',
+    help='compare slowdowns against the baseline at PATH (default: bench/baseline.json).')
+  arg_parser.add_argument('-save-baseline', nargs='?', const=default_baseline_path, metavar='PATH',
+    help='write results as the new baseline to PATH (default: bench/baseline.json).')
+  arg_parser.add_argument('-tolerance', type=float, default=0.25,
+    help='fraction by which a slowdown may exceed its baseline, beyond the noise of the measurement, '
+    'before it counts as a regression.')
+  args = arg_parser.parse_args()
+
+  workloads = args.workloads or sorted(n[:-3] for n in os.listdir(workloads_dir) if n.endswith('.py'))
+  mode_names = args.modes or list(modes)
+  results = measure(args.python, workloads, mode_names, scale=args.scale, repeat=args.repeat)
+  doc = dict(python=python_version(args.python), scale=args.scale, repeat=args.repeat, results=results)
+
+  baseline = None
+  if args.baseline:
+    with open(args.baseline) as f: baseline = json.load(f)
+  regressions = print_table(results, mode_names, baseline, args.tolerance)
+
+  if args.json:
+    write_json(doc, args.json)
+  if args.save_baseline:
+    write_json(doc, args.save_baseline)
+  if regressions:
+    print(f'\n{len(regressions)} regression(s) exceed the tolerance of {args.tolerance:.0%}:', file=sys.stderr)
+    for workload, mode, slowdown, base, noise in regressions:
+      print(f'  {workload} {mode}: {slowdown:.2f}x vs baseline {base:.2f}x (noise {noise:.0%})', file=sys.stderr)
+    exit(1)
+
+
+def measure(python, workloads, mode_names, scale, repeat):
+  '''
+  Return a dictionary mapping each workload to:
+  {'plain': seconds, 'plain_noise': fraction, 'modes': {mode: {'time': seconds, 'noise': fraction, 'slowdown': factor}}}.
+  The runs of each workload are interleaved, one run of the plain command and of each mode per round,
+  so that a change in the load of the machine affects all modes alike, rather than whichever mode ran at the time.
+  '''
+  results = {}
+  with TemporaryDirectory(prefix='coven-bench-') as tmp_dir:
+    trace_path = os.path.join(tmp_dir, 'trace.cov')
+    for workload in workloads:
+      script = os.path.join(workloads_dir, workload + '.py')
+      if not os.path.exists(script): exit(f'bench error: no such workload: {workload}')
+      cmds = { None : [python, script, str(scale)] }
+      for mode in mode_names:
+        cmds[mode] = [python, coven_path, *modes[mode], '-output', trace_path, '--', script, str(scale)]
+      times = { mode : [] for mode in cmds }
+      for _ in range(repeat):
+        for mode, cmd in cmds.items():
+          times[mode].append(cpu_time(cmd))
+      plain, plain_noise = median_and_noise(times.pop(None))
+      result = results[workload] = dict(plain=plain, plain_noise=plain_noise, modes={})
+      for mode, mode_times in times.items():
+        t, noise = median_and_noise(mode_times)
+        result['modes'][mode] = dict(time=t, noise=noise, slowdown=t / plain)
+      print(f'measured: {workload}', file=sys.stderr)
+  return results
+
+
+def cpu_time(cmd):
+  'Run `cmd` and return its CPU time.'
+  proc = Popen(cmd, stdout=DEVNULL)
+  _, status, usage = os.wait4(proc.pid, 0)
+  proc.returncode = status # already reaped.
+  if status: exit(f'bench error: command failed with status {status}: {" ".join(cmd)}')
+  return usage.ru_utime + usage.ru_stime
+
+
+def median_and_noise(times):
+  'Return the median of `times`, and their spread relative to the median.'
+  t = median(times)
+  return t, (max(times) - min(times)) / t
+
+
+def print_table(results, mode_names, baseline, tolerance):
+  'Print the slowdown table, with baseline comparisons if provided; return the list of regressions.'
+  regressions = []
+  base_results = baseline['results'] if baseline else {}
+  print(f'{"workload":<16} {"plain s":>8}  ' + '  '.join(f'{m:>14}' for m in mode_names))
+  for workload, result in results.items():
+    cells = []
+    for mode in mode_names:
+      slowdown = result['modes'][mode]['slowdown']
+      cell = f'{slowdown:.2f}x'
+      try: base = base_results[workload]['modes'][mode]['slowdown']
+      except KeyError: pass
+      else:
+        change = slowdown / base - 1
+        cell += f' {change:+.0%}'
+        noise = result.get('plain_noise', 0) + result['modes'][mode].get('noise', 0)
+        if change > tolerance + noise:
+          cell += '!'
+          regressions.append((workload, mode, slowdown, base, noise))
+      cells.append(f'{cell:>14}')
+    print(f'{workload:<16} {result["plain"]:8.3f}  ' + '  '.join(cells))
+  return regressions
+
+
+def python_version(python):
+  return run([python, '-c', 'import sys; print(sys.version)'], capture_output=True, text=True).stdout.strip()
+
+
+def write_json(doc, path):
+  if path == '-':
+    json.dump(doc, sys.stdout, indent=1, sort_keys=True)
+    print()
+  else:
+    with open(path, 'w') as f:
+      json.dump(doc, f, indent=1, sort_keys=True)
+      f.write('\n')
+
+
+if __name__ == '__main__': main()
@@ -0,0 +1,38 @@
+# Exception-heavy code: raising and handling in loops, with finally clauses and context managers.
+
+from sys import argv
+
+scale = int(argv[1]) if len(argv) > 1 else 1
+
+
+class Resource:
+  def __enter__(self): return self
+  def __exit__(self, *exc_info): return False
+
+
+def parse(token):
+  try:
+    return int(token)
+  except ValueError:
+    try: return float(token)
+    except ValueError: return None
+  finally:
+    pass
+
+
+def checked(i):
+  with Resource():
+    if i % 3 == 0: raise KeyError(i)
+    return i
+
+
+tokens = ['1', '2.5', 'x', '-4', 'nan?', '1e3'] * 5000
+total = 0
+for _ in range(scale):
+  for token in tokens:
+    value = parse(token)
+    if value is not None: total += 1
+  for i in range(50000):
+    try: total += checked(i)
+    except KeyError: total -= 1
+print(total)
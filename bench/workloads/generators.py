@@ -0,0 +1,30 @@
+# Generator pipelines: chained generator functions and expressions, with frequent suspension and resumption.
+
+from sys import argv
+
+scale = int(argv[1]) if len(argv) > 1 else 1
+
+
+def numbers(n):
+  for i in range(n): yield i
+
+
+def evens(it):
+  for i in it:
+    if i % 2 == 0: yield i
+
+
+def windows(it, size):
+  window = []
+  for i in it:
+    window.append(i)
+    if len(window) == size:
+      yield tuple(window)
+      window.clear()
+
+
+total = 0
+for _ in range(scale):
+  squares = (i * i for i in evens(numbers(250000)))
+  total += sum(sum(w) for w in windows(squares, 4))
+print(total)
@@ -0,0 +1,26 @@
+# Import-heavy startup: many stdlib modules are imported, but none are targets, so this measures untargeted overhead.
+# The scale argument is accepted for uniformity, but modules can only be imported once.
+
+import argparse
+import asyncio
+import csv
+import decimal
+import email.parser
+import fractions
+import http.client
+import json
+import logging
+import pathlib
+import pydoc
+import sqlite3
+import statistics
+import string
+import tarfile
+import unittest
+import urllib.request
+import uuid
+import xml.dom.minidom
+import xml.etree.ElementTree
+import zipfile
+
+print(json.dumps(sorted(m for m in dir() if not m.startswith('_'))))
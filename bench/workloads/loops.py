@@ -0,0 +1,13 @@
+# Tight loops: arithmetic and branching in nested loops, with few calls.
+
+from sys import argv
+
+scale = int(argv[1]) if len(argv) > 1 else 1
+
+total = 0
+for i in range(500 * scale):
+  for j in range(500):
+    if (i ^ j) & 1: total += i * j
+    else: total -= j
+    while total > 1000000: total //= 3
+print(total)
@@ -0,0 +1,24 @@
+# Deep and branching recursion: many short activations on a deep stack.
+
+import sys
+from sys import argv
+
+scale = int(argv[1]) if len(argv) > 1 else 1
+sys.setrecursionlimit(5000)
+
+
+def fib(n):
+  if n < 2: return n
+  return fib(n - 1) + fib(n - 2)
+
+
+def depth(n):
+  if n == 0: return 0
+  return 1 + depth(n - 1)
+
+
+total = 0
+for _ in range(scale):
+  total += fib(23)
+  for _ in range(40): total += depth(2000)
+print(total)
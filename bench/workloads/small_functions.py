@@ -0,0 +1,34 @@
+# Many small functions: methods, properties, closures and lambdas, each doing very little work per call.
+
+from sys import argv
+
+scale = int(argv[1]) if len(argv) > 1 else 1
+
+
+class Point:
+  def __init__(self, x, y):
+    self.x = x
+    self.y = y
+
+  @property
+  def norm1(self): return abs(self.x) + abs(self.y)
+
+  def shifted(self, dx): return Point(self.x + dx, self.y)
+
+
+def make_adder(n):
+  def add(x): return x + n
+  return add
+
+
+def identity(x): return x
+
+
+add3 = make_adder(3)
+double = lambda x: x * 2
+total = 0
+for _ in range(scale):
+  for i in range(60000):
+    p = Point(i, -i).shifted(1)
+    total += identity(add3(double(p.norm1)))
+print(total)
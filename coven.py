@@ -3,19 +3,20 @@
 # Note: any modules imported prior to the calls to install_trace and run_path
 # will not report coverage fully, because their <module> code objects will not be captured.
 # Therefore, we only use stdlib modules.
+# Modules that only analysis and reporting need (e.g. dis and re) are imported by the functions that use them,
+# so that they do not delay the start of the traced command.
 import sys; assert sys.version_info >= (3, 7, 0)
 import marshal
+from array import array
 import os
 import os.path
-import re
-from collections import defaultdict
-from dis import Instruction, findlinestarts, get_instructions, hasjabs, hasjrel, opname, opmap
+from collections import defaultdict, namedtuple
 from argparse import ArgumentParser
-from inspect import getmodule
-from itertools import chain
+from itertools import chain, islice
+from opcode import hasjabs, hasjrel, opname, opmap
 from os.path import abspath as abs_path, join as path_join, normpath as normalize_path
-from runpy import run_path
-from sys import exc_info, settrace, stderr, stdout
+from sys import exc_info, gettrace, settrace, stderr, stdout
+from time import perf_counter, process_time
 from types import CodeType
 
 
@@ -26,19 +27,162 @@ def main():
   arg_parser.add_argument('-show-all', action='store_true')
   arg_parser.add_argument('-color-on', dest='color', action='store_true', default=stdout.isatty())
   arg_parser.add_argument('-color-off', dest='color', action='store_false')
+  arg_parser.add_argument('-cache-dir', default=os.environ.get(CACHE_DIR_ENV_VAR) or None, metavar='DIR',
+    help=f'enable the persistent cache of static edge analysis, in DIR (default: ${CACHE_DIR_ENV_VAR}); '
+    'without either, nothing is cached.')
+  arg_parser.add_argument('-cache-size', type=float, default=256, metavar='MB',
+    help='maximum size of the analysis cache in megabytes; least recently used entries are evicted.')
+  arg_parser.add_argument('-no-cache', action='store_true',
+    help=f'disable the analysis cache, even if -cache-dir or ${CACHE_DIR_ENV_VAR} is set.')
+  arg_parser.add_argument('-jobs', type=int, default=1, metavar='N',
+    help='analyze files (and load traces when coalescing, if they total at least 4 MB) in N worker processes; '
+    'output is identical to a serial run.')
+  arg_parser.add_argument('-progress', action='store_true', help='print coalesce progress and phase timings to stderr.')
+  arg_parser.add_argument('-stream-mem', type=float, metavar='MB',
+    help='coalesce in streaming mode: merge and report each path incrementally, spilling merged edges to temporary files '
+    'whenever the estimated size of the edges in memory exceeds this ceiling.')
+  arg_parser.add_argument('-lines', action='store_true',
+    help='statement coverage: trace only line events, and report lines from the line tables without edge analysis; '
+    'traces recorded with `-lines` must also be coalesced with `-lines`.')
+  arg_parser.add_argument('-json-lines', metavar='PATH',
+    help='also write the per-file line and edge status and the totals of the report as JSON Lines to PATH.')
+  arg_parser.add_argument('-lcov', metavar='PATH', help='also write the report in LCOV tracefile format to PATH.')
+  arg_parser.add_argument('-cobertura', metavar='PATH', help='also write the report as Cobertura XML to PATH.')
+  arg_parser.add_argument('-index', metavar='DB', help='the SQLite trace index for `-update-index` and `-select-traces`.')
+  arg_parser.add_argument('-diff-base', default='HEAD', metavar='REV',
+    help='the git revision against which `-select-traces` diffs the working tree (default: HEAD).')
+  arg_parser.add_argument('-connect', metavar='SOCKET',
+    help='send the request to the analysis daemon listening on SOCKET (see `-daemon`) instead of analyzing here.')
+  arg_parser.add_argument('-daemon-request', choices=daemon_requests, default='report',
+    help='with `-connect`: `report` (default) coalesces the `-coalesce` traces; `summary` does the same, '
+    'but prints only the totals; `stats` prints the cache statistics of the daemon; `shutdown` stops it.')
+  arg_parser.add_argument('-daemon-entries', type=int, default=100000, metavar='N',
+    help='with `-daemon`: the maximum number of code analyses and of source files kept in memory; '
+    'least recently used entries are evicted.')
+  arg_parser.add_argument('-preload', nargs='+', default=[], metavar='MODULE',
+    help='with `-batch`: modules that the fork server imports before forking any worker; '
+    'their module-level code is not traced, so they cannot be targets.')
+  arg_parser.add_argument('-batch-dir', metavar='DIR',
+    help='with `-batch`: keep the trace, stdout and stderr of each command in DIR, named by the index of the command, '
+    'and print the exit code, index and command of each instead.')
+  arg_parser.set_defaults(warm_caches=None)
   excl = arg_parser.add_mutually_exclusive_group()
   excl.add_argument('-coalesce', nargs='+')
+  excl.add_argument('-update-index', nargs='+', metavar='TRACE',
+    help='add trace files to the `-index` trace index, reindexing those that changed since they were indexed; '
+    'indexed traces that no longer exist are dropped.')
+  excl.add_argument('-select-traces', nargs='*', metavar='PATH[:LINE[-LINE]]',
+    help='print the traces in the `-index` trace index that traced any of the given changes; '
+    'if none are given, the changes are those of the working tree relative to the `-diff-base` git revision.')
+  excl.add_argument('-who-covers', metavar='PATH:LINE',
+    help='print the labels of the contexts in the `-contexts-db` database that traced line LINE of PATH.')
+  excl.add_argument('-batch', metavar='JOBS',
+    help='trace each command listed in the file JOBS (or stdin for `-`), one per line, in forked workers of a fork server '
+    'that imports the modules needed for tracing once; `-jobs` workers run in parallel. Each command has the exit code '
+    'and output of a lone run; the outputs are printed in order, and the traces are coalesced, unless `-batch-dir` is set. '
+    'A command that starts after every earlier command has finished (always, with `-jobs 1`) writes to the terminal '
+    'directly; one that runs ahead of an earlier command is buffered, and its stdout is printed before its stderr.')
+  excl.add_argument('-daemon', metavar='SOCKET',
+    help='run a long-lived analysis daemon on the Unix socket SOCKET, which keeps code analyses, source texts and '
+    'ignored lines in memory, invalidated by source mtime and digest, and answers `-connect` requests.')
+  arg_parser.add_argument('-profile-coven', nargs='?', const='-', metavar='PATH',
+    help="measure coven's own cost: wall time, CPU time and peak memory (tracemalloc) for each phase, "
+    'plus per-file and per-code analysis times; print a summary to stderr, or write JSON to PATH.')
   trace_group = excl.add_argument_group('trace')
   trace_group.add_argument('-output')
+  trace_group.add_argument('-format', choices=('indexed', 'marshal'), default='indexed',
+    help='trace file format: `indexed` (default; per-path sections with a header index) or the legacy `marshal` format.')
+  trace_group.add_argument('-compress', choices=('zlib', 'lzma', 'none'), default='zlib',
+    help='compression for the path sections of indexed trace files.')
+  trace_group.add_argument('-engine', choices=trace_engines, default='settrace',
+    help='tracing backend: `settrace` (default), '
+    'or `probes`: rewrite target code as it is imported so that it records its own edges, '
+    'leaving non-target code untraced entirely; implies `-record bits`.')
+  trace_group.add_argument('-record', choices=('sets', 'bits'), default='sets',
+    help='edge recording: `sets` of traced edges (default), or `bits`: one byte per statically inferred edge.')
+  trace_group.add_argument('-saturate', action='store_true',
+    help='stop tracing code objects once all of their required edges are covered; implies `-record bits`.')
+  trace_group.add_argument('-sample', type=float, metavar='RATE',
+    help='trace only this fraction (0 < RATE <= 1) of the calls to each code object; the trace is flagged as sampled. '
+    'This reduces the cost of opcode tracing, but every call still runs the tracer, so the overhead is not bounded; '
+    'see `-sample-window`.')
+  trace_group.add_argument('-sample-window', type=float, metavar='SECONDS',
+    help='with `-sample`: instead of sampling calls, trace the main thread in windows of SECONDS of CPU time, '
+    'with untraced intervals between them, so that tracing takes at most RATE of the CPU time '
+    'and the overhead is at most RATE / (1 - RATE). Activations are traced only while a window is open; '
+    'other threads are not traced.')
+  trace_group.add_argument('-subprocesses', action='store_true',
+    help='also trace forked children, multiprocessing workers, and Python subprocesses of the command; '
+    'each process writes its own trace, and all traces are coalesced when the command completes; '
+    'requires `-engine settrace`.')
+  trace_group.add_argument('-contexts-db', metavar='DB',
+    help='also record the edges traced in each dynamic context, and store them in the SQLite database DB, '
+    'replacing the previous rows of any context that was recorded again. '
+    'Contexts are set by `coven.set_context(label)` in the traced code, or by `-test-contexts`; '
+    'edges traced outside of any context have the empty label. Subprocesses do not record contexts.')
+  trace_group.add_argument('-test-contexts', action='store_true',
+    help='with `-contexts-db`: each call to a function whose name starts with `test` is its own context, '
+    'labeled with the module and qualified name of the function; requires `-engine settrace`.')
+  trace_group.add_argument('-m', dest='module', metavar='MODULE',
+    help='run library module MODULE as the main module, as `python -m` does; `cmd` is then its arguments.')
   trace_group.add_argument('cmd', nargs='*')
   args = arg_parser.parse_args()
+  if args.sample is not None and not (0 < args.sample <= 1):
+    arg_parser.error(f'-sample rate must be in the range (0, 1]: {args.sample}')
+  if args.sample_window is not None:
+    if args.sample is None or args.sample == 1: arg_parser.error('-sample-window requires a -sample rate less than 1.')
+    if args.sample_window <= 0: arg_parser.error(f'-sample-window must be positive: {args.sample_window}')
+    if args.test_contexts: arg_parser.error('-sample-window does not support -test-contexts.')
+  if args.engine == 'probes' and (args.saturate or args.sample is not None):
+    arg_parser.error('-engine probes does not support -saturate or -sample.')
+  if args.engine == 'probes' and args.subprocesses:
+    arg_parser.error('-engine probes does not support -subprocesses: '
+      'spawned and exec\'d Python children run their main module without importing it, so it is never probed.')
+  if args.lines and (args.saturate or args.record != 'sets' or args.engine == 'probes'):
+    arg_parser.error('-lines does not support -saturate, -record bits or -engine probes.')
+  if args.contexts_db and args.saturate:
+    arg_parser.error('-contexts-db does not support -saturate.')
+  if args.test_contexts and not (args.contexts_db and args.engine == 'settrace'):
+    arg_parser.error('-test-contexts requires -contexts-db and -engine settrace.')
+  if args.who_covers:
+    if not args.contexts_db: arg_parser.error('-who-covers requires -contexts-db.')
+    path, _, line = args.who_covers.rpartition(':')
+    if not (path and line.isdigit()): arg_parser.error(f'-who-covers expects PATH:LINE: {args.who_covers!r}')
+    for label in query_line_contexts(args.contexts_db, path, int(line)): print(label or '(no context)')
+    return
+  if args.update_index or args.select_traces is not None:
+    if not args.index: arg_parser.error('-update-index and -select-traces require -index.')
+    if args.update_index:
+      update_trace_index(args.index, args.update_index, cache=crawl_cache_for_args(args), progress=args.progress)
+    else:
+      changes = parse_changes(args.select_traces) if args.select_traces else git_changed_lines(args.diff_base)
+      for trace_path in select_indexed_traces(args.index, changes): print(path_rel_to_current_or_abs(trace_path))
+    return
   arg_targets = expand_targets(args.targets)
+  if args.connect:
+    if args.daemon_request in ('report', 'summary') and not args.coalesce:
+      arg_parser.error(f'-daemon-request {args.daemon_request} requires -coalesce.')
+    daemon_client(socket_path=args.connect, arg_targets=arg_targets, args=args)
+    return
+  if args.daemon:
+    serve_daemon(socket_path=args.daemon, args=args)
+    return
+  if args.batch:
+    if args.cmd or args.module: arg_parser.error('-batch does not take a command.')
+    if args.batch_dir and args.output: arg_parser.error('-batch-dir does not support -output.')
+    preloaded_targets = set(args.preload) & arg_targets
+    if preloaded_targets: arg_parser.error(f'-preload modules cannot be targets: {", ".join(sorted(preloaded_targets))}')
+    failures = run_batch(jobs=read_batch_jobs(args.batch), arg_targets=arg_targets, args=args)
+    exit(1 if failures else 0)
+  profile = CovenProfile() if args.profile_coven else None
   if args.coalesce:
-    coalesce(trace_paths=args.coalesce, arg_targets=arg_targets, args=args)
+    coalesce(trace_paths=args.coalesce, arg_targets=arg_targets, args=args, profile=profile)
+    if profile: profile.emit(args.profile_coven)
   else:
-    if not args.cmd:
+    if not (args.cmd or args.module):
       arg_parser.error('please specify a command.')
-    trace_cmd(cmd=args.cmd, arg_targets=arg_targets, output_path=args.output, args=args)
+    trace_cmd(cmd=args.cmd, arg_targets=arg_targets, output_path=args.output, args=args, profile=profile,
+      module=args.module)
 
 
 def expand_targets(arg_targets):
@@ -64,23 +208,52 @@ def expand_module_path(path):
   return stem.replace('/', '.')
 
 
-def trace_cmd(cmd, arg_targets, output_path, args):
-  'NOTE: this must be called before importing any module that we might wish to trace with coven.'
-  cmd_path = cmd[0]
+def trace_cmd(cmd, arg_targets, output_path, args, profile=None, module=None):
+  '''
+  Trace `cmd`, a script path and its arguments; or if `module` is set, run that module as `python -m` does,
+  with `cmd` as its arguments.
+  NOTE: this must be called before importing any module that we might wish to trace with coven.
+  '''
+  cmd_path = module or cmd[0]
   targets = set(arg_targets or ['__main__'])
   # although run_path alters and restores sys.argv[0],
   # we need to replace all of argv to provide the correct arguments to the command getting traced.
   orig_argv = sys.argv.copy()
-  sys.argv = cmd.copy()
+  sys.argv = [module, *cmd] if module else cmd.copy()
   # also need to fix the search path to imitate the regular interpreter.
   orig_path = sys.path
   sys.path = orig_path.copy()
-  sys.path[0] = os.path.dirname(cmd[0]) # not sure if this is right in all cases.
+  sys.path[0] = os.getcwd() if module else os.path.dirname(cmd[0]) # not sure if this is right in all cases.
   exit_code = 0
-  code_edges = install_trace(targets, dbg=args.dbg)
+  subprocess_dir = None
+  if args.subprocesses:
+    from tempfile import mkdtemp
+    # Not a TemporaryDirectory, because forked children would remove it when they exit.
+    subprocess_dir = mkdtemp(prefix='coven-')
+    orig_env = enable_subprocess_tracing(subprocess_dir, subprocess_config(subprocess_dir, targets, args))
+  trace_pid = os.getpid()
+  import runpy # not needed by the other commands, but must be imported before the trace is installed; see run_main.
+  with profile_phase(profile, 'install'):
+    code_edges = install_trace(targets, dbg=args.dbg, engine=args.engine,
+      record=trace_record_mode(args), saturate=args.saturate, sample=args.sample, sample_window=args.sample_window,
+      main_file=(None if module else cmd_path), main_module=module, test_contexts=args.test_contexts)
+  if args.contexts_db: code_edges.record_contexts()
+  set_active_code_edges(code_edges if args.contexts_db else None)
+  if module:
+    # Finding the module imports its parent packages, which happens under the trace, just as runpy would do it.
+    main_path = module_main_path(module)
+    if main_path is None:
+      uninstall_trace(code_edges)
+      exit(f'coven error: could not find module to run: {module!r}')
+  else:
+    main_path = abs_path(cmd_path)
+  if subprocess_dir:
+    trace_forks(subprocess_config(subprocess_dir, targets, args), code_edges, register_exit=False,
+      main_path=main_path)
   #if dbg: errSL('coven untraceable modules (imported prior to `install_trace`):', sorted(sys.modules.keys()))
   try:
-    run_path(cmd_path, run_name='__main__')
+    with profile_phase(profile, 'run'):
+      run_main(cmd_path, module=module)
     #^ Use cmd_path as is (instead of the absolute path), so that it appears as it would naturally in a stack trace.
     #^ NOTE: this changes the appearance of stack traces; see fixup_traceback below.
     #^ It might also cause other subtle behavioral changes.
@@ -97,40 +270,388 @@ def trace_cmd(cmd, arg_targets, output_path, args):
     fixup_traceback(traceback)
     print(*traceback.format(), sep='', end='', file=stderr)
   finally:
-    settrace(None)
+    uninstall_trace(code_edges)
     stdout.flush()
     stderr.flush()
   sys.argv = orig_argv
+  if args.contexts_db and os.getpid() == trace_pid:
+    set_active_code_edges(None)
+    code_edges.finish_contexts()
+    with profile_phase(profile, 'write contexts'):
+      write_contexts_db(args.contexts_db, code_edges.context_edges)
+  if os.getpid() != trace_pid:
+    # A forked child of the command returned through run_path instead of exiting;
+    # its trace is written by the exit handler that `trace_forks` registered in the child.
+    exit(exit_code)
+
+  with profile_phase(profile, 'collect'):
+    # Note: __main__ is handled specially:
+    # sys.modules['__main__'] points to coven, while we want the absolute guest command path.
+    target_paths = trace_target_paths(targets, main_path=main_path, dbg=args.dbg)
+
+    # Group code by path; this is necessary for per-file display,
+    # and also lets us store code belonging to __main__ by absolute path,
+    # which disambiguates multiple different mains for coalesced test scripts.
+    # Without the call to `abs_path`, co_filename might be relative in the __main__ case.
+    path_code_edges = defaultdict(dict)
+    for code, edges in code_edges.items():
+      path_code_edges[abs_path(code.co_filename)][code] = edges
+    path_code_edges = dict(path_code_edges) # convert to plain dict for marshal / safety.
+
+    sample_rate = args.sample or 1.0
+    sampled = int(sample_rate < 1)
+    target_path_lists = { t : [p] for t, p in target_paths.items() }
+    if subprocess_dir:
+      os.environ.clear()
+      os.environ.update(orig_env)
+      target_path_lists, path_code_edges, sampled = merge_subprocess_traces(subprocess_dir, target_paths,
+        path_code_edges, sampled)
+      from shutil import rmtree
+      rmtree(subprocess_dir)
+      target_paths = target_path_lists
+  if output_path:
+    with profile_phase(profile, 'write'):
+      write_coverage(output_path=output_path, target_paths=target_paths, path_code_edges=path_code_edges,
+        sample_rate=sample_rate, format=args.format, compression=args.compress)
+  else:
+    with profile_phase(profile, 'report'):
+      report(target_path_lists=target_path_lists, path_code_edges=path_code_edges, args=args, sampled=sampled,
+        profile=profile)
+  if profile: profile.emit(args.profile_coven)
+  exit(exit_code)
+
+
+def set_active_code_edges(code_edges):
+  '''
+  Set the `CodeEdges` that `set_context` acts upon.
+  When coven runs as a script, its module is `__main__` rather than `coven`,
+  so it is also registered as `coven`, lest `import coven` in the traced code load a second, inactive copy.
+  '''
+  global active_code_edges
+  active_code_edges = code_edges
+  module = sys.modules[__name__]
+  if module.__name__ != 'coven': sys.modules.setdefault('coven', module)
+
+
+def trace_record_mode(args):
+  if args.lines: return 'lines'
+  return 'bits' if args.saturate else args.record
+
+
+def run_main(cmd_path, module=None):
+  '''
+  Run the command as `__main__`, exactly as `run_path` does, or the library `module` as `run_module` does.
+  With the probes engine, the main code must be instrumented before it runs,
+  so for a source file it is compiled here and passed through the `TargetImportFinder`;
+  a main module is instrumented by the finder itself when runpy finds it.
+  '''
+  from runpy import _run_module_code, run_module, run_path # already imported by trace_cmd.
+  if module:
+    run_module(module, run_name='__main__', alter_sys=True)
+    return
+  finder = next((f for f in sys.meta_path if isinstance(f, TargetImportFinder)), None)
+  if finder is None or finder.rewrite is None or finder.main_file is None or not os.path.isfile(cmd_path):
+    run_path(cmd_path, run_name='__main__')
+    return
+  with open(cmd_path, 'rb') as f: source = f.read()
+  code = finder.register(compile(source, cmd_path, 'exec'))
+  _run_module_code(code, mod_name='__main__', pkg_name='', script_name=cmd_path)
+
+
+def module_main_path(module):
+  '''
+  Return the absolute path of the code that `run_module` runs for `module`
+  (the `__main__` submodule of a package), or None if it cannot be found.
+  '''
+  from importlib.util import find_spec
+  try:
+    spec = find_spec(module)
+    if spec is not None and spec.submodule_search_locations is not None:
+      spec = find_spec(module + '.__main__')
+  except (ImportError, ValueError): return None
+  if spec is None or not spec.has_location: return None
+  return abs_path(spec.origin)
+
 
-  # Generate the target paths dictionary.
-  # Path values may be None, indicating that the target was never imported / has no coverage.
-  # Note: __main__ is handled specially:
-  # sys.modules['__main__'] points to coven, while we want the absolute guest command path.
+def trace_target_paths(targets, main_path, dbg):
+  '''
+  Generate the target paths dictionary.
+  Path values may be None, indicating that the target was never imported / has no coverage.
+  '''
   target_paths = {}
   for target in sorted(targets):
     if target == '__main__':
-      path = abs_path(cmd_path)
+      path = main_path
     else:
       try: path = sys.modules[target].__file__
       except KeyError: path = None
     target_paths[target] = path
-    if args.dbg: errSL(f'target_paths: {target} -> {path}')
+    if dbg: errSL(f'target_paths: {target} -> {path}')
+  return target_paths
 
-  # Group code by path; this is necessary for per-file display,
-  # and also lets us store code belonging to __main__ by absolute path,
-  # which disambiguates multiple different mains for coalesced test scripts.
-  # Without the call to `abs_path`, co_filename might be relative in the __main__ case.
-  path_code_edges = defaultdict(dict)
-  for code, edges in code_edges.items():
-    path_code_edges[abs_path(code.co_filename)][code] = edges
-  path_code_edges = dict(path_code_edges) # convert to plain dict for marshal / safety.
 
-  if output_path:
-    write_coverage(output_path=output_path, target_paths=target_paths, path_code_edges=path_code_edges)
-  else:
-    target_path_lists = { t : [p] for t, p in target_paths.items() }
-    report(target_path_lists=target_path_lists, path_code_edges=path_code_edges, args=args)
-  exit(exit_code)
+# Batch mode.
+# The coven process is a fork server: it imports the modules that tracing needs, and any `-preload` modules, once;
+# then it forks a worker for each command, which traces it exactly as `trace_cmd` does for a lone command.
+# Workers exit through the normal interpreter shutdown, so exit codes, exit handlers and output are those of a lone run.
+# Nothing on the path from `run_batch` to the interpreter exit may catch or clean up on behalf of the server,
+# because forked workers leave through that same path.
+
+batch_preloads = ('hashlib', 'runpy', 'struct', 'threading', 'traceback') # Imported lazily by the trace phase.
+
+
+def read_batch_jobs(path):
+  '''
+  Read the commands of a batch file (or stdin for '-'): one command per line, split like a shell command line.
+  A command is a script path and its arguments, or `-m MODULE` and its arguments. Blank lines and # comments are skipped.
+  '''
+  import shlex
+  f = sys.stdin if path == '-' else open(path)
+  jobs = []
+  for line_num, line in enumerate(f, 1):
+    cmd = shlex.split(line, comments=True)
+    if not cmd: continue
+    if cmd[0] == '-m' and len(cmd) < 2: exit(f'coven error: {path}:{line_num}: `-m` requires a module name.')
+    jobs.append(cmd)
+  if f is not sys.stdin: f.close()
+  return jobs
+
+
+def run_batch(jobs, arg_targets, args):
+  '''
+  Trace each command of `jobs` in its own forked worker, running up to `args.jobs` workers at a time.
+  Each worker writes a trace.
+  With `-batch-dir`, the stdout and stderr of each worker go to files in that directory, named by the index of the command,
+  and a line with the exit code, index and command of each job is printed.
+  Otherwise, the output of each command appears in the order of the commands,
+  and the coalesced traces are written to `-output` or reported.
+  A worker that starts once every earlier command has been emitted (always, with one job at a time)
+  inherits stdout and stderr, so its output is live, interleaved, and goes to the same terminal as a lone run.
+  A worker that starts while an earlier command is still running cannot write in order,
+  so its stdout and stderr go to files, which are copied out (stdout, then stderr) once its turn comes.
+  Return the number of commands that exited with a nonzero code.
+  '''
+  from importlib import import_module
+  from shlex import quote
+  from tempfile import mkdtemp
+  for name in (*batch_preloads, *args.preload): import_module(name)
+  trace_compressor(args.compress) # imports the compression module.
+  if args.batch_dir:
+    out_dir = args.batch_dir
+    os.makedirs(out_dir, exist_ok=True)
+  else: # Not a TemporaryDirectory, because forked workers would remove it when they exit.
+    out_dir = mkdtemp(prefix='coven-batch-')
+  width = len(str(len(jobs) - 1))
+  job_paths = [path_join(out_dir, f'{i:0{width}}') for i in range(len(jobs))]
+  is_direct = [False] * len(jobs) # Whether each job writes to stdout and stderr directly.
+  exit_codes = [None] * len(jobs)
+  pids = {} # Maps the pids of running workers to job indices.
+  next_job = 0
+  next_emit = 0 # Index of the next job whose output and status are emitted, in order.
+  while next_emit < len(jobs):
+    if next_job < len(jobs) and len(pids) < args.jobs:
+      is_direct[next_job] = not args.batch_dir and next_job == next_emit
+      if not is_direct[next_job]:
+        out_fd = os.open(job_paths[next_job] + '.stdout', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        err_fd = os.open(job_paths[next_job] + '.stderr', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+      stdout.flush()
+      stderr.flush()
+      pid = os.fork()
+      if pid == 0: # worker; never returns.
+        if not is_direct[next_job]:
+          os.dup2(out_fd, 1)
+          os.dup2(err_fd, 2)
+          os.close(out_fd)
+          os.close(err_fd)
+        cmd = jobs[next_job]
+        module = cmd[1] if cmd[0] == '-m' else None
+        trace_cmd(cmd=(cmd[2:] if module else cmd), arg_targets=arg_targets, output_path=job_paths[next_job] + '.cov',
+          args=args, module=module)
+      if not is_direct[next_job]:
+        os.close(out_fd)
+        os.close(err_fd)
+      pids[pid] = next_job
+      next_job += 1
+      continue
+    pid, status = os.wait()
+    exit_codes[pids.pop(pid)] = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    while next_emit < len(jobs) and exit_codes[next_emit] is not None:
+      i = next_emit
+      next_emit += 1
+      cmd_text = ' '.join(quote(word) for word in jobs[i])
+      if args.batch_dir:
+        print(f'{exit_codes[i]}\t{i:0{width}}\t{cmd_text}', flush=True)
+        continue
+      if not is_direct[i]:
+        for suffix, f in (('.stdout', stdout), ('.stderr', stderr)):
+          with open(job_paths[i] + suffix) as job_f: f.write(job_f.read())
+          f.flush()
+      if exit_codes[i]: errSL(f'coven batch: exit code {exit_codes[i]}: {cmd_text}')
+  if not args.batch_dir:
+    trace_paths = [p + '.cov' for p in job_paths if os.path.isfile(p + '.cov')]
+    if args.output:
+      target_path_sets, path_key_edges, path_codes, _ = load_traces(trace_paths, arg_targets=[])
+      path_code_edges = { path : code_edges_for_keys(key_edges, path_codes[path])
+        for path, key_edges in path_key_edges.items() }
+      write_coverage(output_path=args.output, target_paths={ t : sorted(paths) for t, paths in target_path_sets.items() },
+        path_code_edges=path_code_edges, sample_rate=args.sample or 1.0, format=args.format, compression=args.compress)
+    elif trace_paths:
+      coalesce(trace_paths=trace_paths, arg_targets=arg_targets, args=args)
+    from shutil import rmtree
+    rmtree(out_dir)
+  return sum(1 for code in exit_codes if code)
+
+
+# Subprocess tracing.
+# The traced command's environment carries a JSON configuration in SUBPROCESS_ENV_VAR,
+# and PYTHONPATH is prefixed with a directory containing a generated `sitecustomize` module,
+# which loads coven in every Python subprocess (including multiprocessing `spawn` and `forkserver` workers)
+# and calls `start_subprocess_trace` before the subprocess runs its main module.
+# Forked children inherit the tracer itself; `trace_forks` resets their edges and arranges for them to write a trace.
+# Each process writes its own trace file to the directory, named by pid,
+# and the parent coalesces them once the command completes.
+SUBPROCESS_ENV_VAR = 'COVEN_SUBPROCESS'
+
+
+def subprocess_config(trace_dir, targets, args):
+  return dict(dir=trace_dir, targets=sorted(targets), dbg=args.dbg, engine=args.engine,
+    record=trace_record_mode(args), saturate=args.saturate, sample=args.sample, sample_window=args.sample_window,
+    format=args.format, compress=args.compress)
+
+
+def enable_subprocess_tracing(trace_dir, config):
+  'Write the startup hook and alter the environment so that subprocesses trace themselves; return the original environment.'
+  import json
+  hook_dir = path_join(trace_dir, 'hook')
+  os.mkdir(hook_dir)
+  with open(path_join(hook_dir, 'sitecustomize.py'), 'w') as f:
+    f.write(subprocess_hook_template.format(hook_dir=hook_dir, coven_path=abs_path(__file__)))
+  orig_env = dict(os.environ)
+  os.environ[SUBPROCESS_ENV_VAR] = json.dumps(config)
+  python_path = os.environ.get('PYTHONPATH')
+  os.environ['PYTHONPATH'] = hook_dir + (os.pathsep + python_path if python_path else '')
+  return orig_env
+
+
+subprocess_hook_template = '''\
+# Generated by coven: trace this subprocess, then load any `sitecustomize` module that this one shadows.
+import sys
+
+def _coven_start_subprocess_trace():
+  from importlib.machinery import PathFinder
+  from importlib.util import module_from_spec, spec_from_file_location
+  try: sys.path.remove({hook_dir!r})
+  except ValueError: pass
+  try:
+    spec = spec_from_file_location('coven', {coven_path!r})
+    coven = module_from_spec(spec)
+    spec.loader.exec_module(coven)
+    coven.start_subprocess_trace()
+  except Exception as e:
+    print(f'coven warning: could not trace subprocess: {{e!r}}', file=sys.stderr)
+  spec = PathFinder.find_spec('sitecustomize', sys.path)
+  if spec is not None:
+    module = module_from_spec(spec)
+    sys.modules['sitecustomize'] = module
+    spec.loader.exec_module(module)
+
+_coven_start_subprocess_trace()
+'''
+
+
+def start_subprocess_trace():
+  'Called by the generated `sitecustomize` hook at subprocess startup.'
+  import json
+  try: config = json.loads(os.environ[SUBPROCESS_ENV_VAR])
+  except KeyError: return
+  targets = set(config['targets'])
+  # multiprocessing `spawn` workers import the parent's main module as `__mp_main__`.
+  if '__main__' in targets: targets.add('__mp_main__')
+  code_edges = install_trace(targets, dbg=config['dbg'], engine=config['engine'], record=config['record'],
+    saturate=config['saturate'], sample=config['sample'], sample_window=config['sample_window'])
+  trace_forks(config, code_edges, register_exit=True)
+
+
+def trace_forks(config, code_edges, register_exit, main_path=None):
+  '''
+  Arrange for the current process and its forked children to each write a trace of `code_edges` to the trace directory.
+  After a fork, the child's copy of `code_edges` is reset in place (the tracer holds references to the edge containers),
+  so that each trace contains only the edges traced by its own process.
+  Code that the parent had already saturated remains untraced in the child; the parent's trace covers it.
+  Processes write their trace at exit; multiprocessing workers, which exit via `os._exit`,
+  write theirs when `BaseProcess._bootstrap` returns. Other children that call `os._exit` are not recorded.
+  If `register_exit` is false then the current process is responsible for its own trace, but its children are not.
+  `main_path` overrides the path of the `__main__` target, which is otherwise that of the main module at exit;
+  this is necessary for children forked by `trace_cmd`, because run_path restores coven as the main module.
+  '''
+  import atexit
+  from multiprocessing.process import BaseProcess
+  trace_dir = config['dir']
+  is_exit_registered = False
+  is_written = False
+
+  def write_process_trace():
+    nonlocal is_written
+    if is_written or not os.path.isdir(trace_dir): return
+    is_written = True
+    code_edges.merge_shards()
+    path_code_edges = defaultdict(dict)
+    for code, edges in list(code_edges.items()):
+      if any(edges): path_code_edges[abs_path(code.co_filename)][code] = edges
+    if not path_code_edges: return
+    path = main_path
+    if path is None:
+      main = sys.modules.get('__mp_main__') or sys.modules.get('__main__')
+      path = getattr(main, '__file__', None)
+      if path is not None: path = abs_path(path)
+    target_paths = trace_target_paths(config['targets'], main_path=path, dbg=config['dbg'])
+    write_coverage(output_path=path_join(trace_dir, f'{os.getpid()}-{os.urandom(4).hex()}.cov'),
+      target_paths=target_paths, path_code_edges=dict(path_code_edges), sample_rate=config['sample'] or 1.0,
+      format=config['format'], compression=config['compress'])
+
+  def register_exit_handler():
+    nonlocal is_exit_registered
+    if is_exit_registered: return
+    is_exit_registered = True
+    atexit.register(write_process_trace)
+
+  def after_fork_in_child():
+    nonlocal is_written
+    is_written = False
+    code_edges.reset()
+    code_edges.record_contexts(False) # the contexts of the parent remain with the parent.
+    register_exit_handler()
+
+  orig_bootstrap = BaseProcess._bootstrap
+  def _bootstrap(self, *args, **kwargs):
+    try: return orig_bootstrap(self, *args, **kwargs)
+    finally: write_process_trace()
+
+  BaseProcess._bootstrap = _bootstrap
+  os.register_at_fork(after_in_child=after_fork_in_child)
+  if register_exit: register_exit_handler()
+
+
+def merge_subprocess_traces(trace_dir, target_paths, path_code_edges, sampled):
+  '''
+  Merge the traces written by subprocesses with those of the parent.
+  Return (target_path_lists, path_code_edges, sampled).
+  '''
+  trace_paths = sorted(path_join(trace_dir, name) for name in os.listdir(trace_dir) if name.endswith('.cov'))
+  target_path_sets, path_key_edges, path_codes, sub_sampled = load_traces(trace_paths, arg_targets=[])
+  target_path_sets = defaultdict(set, target_path_sets)
+  add_target_paths(target_path_sets, target_paths, arg_targets=[])
+  for path, code_edges in path_code_edges.items():
+    key_edges = path_key_edges.setdefault(path, {})
+    codes = path_codes.setdefault(path, {})
+    for code, edges in code_edges.items():
+      key = code_key(code)
+      codes.setdefault(key, code)
+      merge_edges(key_edges, key, edges, codes)
+  target_path_lists = { t : sorted(paths) for t, paths in target_path_sets.items() }
+  path_code_edges = { path : code_edges_for_keys(key_edges, path_codes[path])
+    for path, key_edges in path_key_edges.items() }
+  return target_path_lists, defaultdict(dict, path_code_edges), sampled + sub_sampled
 
 
 # Fake instruction/line offsets.
@@ -139,15 +660,387 @@ LINE_RAISED = OFF_RAISED = OP_RAISED = -2
 LINE_RETURN = OFF_RETURN = OP_RETURN = -3
 
 
-def install_trace(targets, dbg):
-  'NOTE: this must be called before importing any module that we might wish to trace with coven.'
-  if dbg: errSL("coven targets:", targets)
+trace_engines = ('settrace', 'probes')
+record_modes = ('sets', 'bits', 'lines')
+
+
+def install_trace(targets, dbg, engine='settrace', record='sets', saturate=False, sample=None, sample_window=None,
+ main_file=None, main_module=None, test_contexts=False):
+  '''
+  Install the tracing engine and return the `code_edges` dictionary that it populates,
+  which maps code objects to either sets of (prev_offset, offset, line) edges (record='sets'),
+  edge bitmaps as described in `code_edge_ids` (record='bits'), or sets of traced lines (record='lines').
+  Threads started after installation are traced too, each into its own shard of the dictionary; see `CodeEdges`.
+  If `saturate` is set, code objects whose required edges have all been traced are no longer traced;
+  this requires record='bits'.
+  If `sample` is a rate less than 1, only that fraction of the calls to each code object are traced (see `call_sampler`),
+  unless `sample_window` is set, in which case the main thread is traced in windows of that many seconds of CPU time,
+  for that fraction of the CPU time (see `install_sample_windows`).
+  The probes engine always records bits, and identifies targets with a `TargetImportFinder` as they are imported,
+  because it instruments target code before it runs; it does not support saturation or sampling.
+  For the finder, `main_file` is the filename of the `__main__` code, which is run rather than imported;
+  alternatively, `main_module` is the name of the module that runpy finds and runs as `__main__`.
+  If `test_contexts` is set, each call to a test function switches to its own dynamic context (see `test_context_label`);
+  only the settrace engine supports this. Edges are only recorded per context once `CodeEdges.record_contexts` is called.
+  NOTE: this must be called before importing any module that we might wish to trace with coven.
+  '''
+  if sample_window is not None and not (engine == 'settrace' and sample is not None and sample < 1 and not test_contexts):
+    raise ValueError('coven error: windowed sampling requires the settrace engine, a sample rate less than 1, '
+      'and no test contexts.')
+  if engine == 'probes':
+    if saturate or sample is not None or record == 'lines':
+      raise ValueError('coven error: the probes engine does not support saturation, sampling or recording lines.')
+    record = 'bits'
+  if dbg: errSL("coven targets:", targets, "engine:", engine, "record:", record, "saturate:", saturate, "sample:", sample)
+  if record not in record_modes: raise ValueError(f'coven error: unknown record mode: {record!r}')
+  if saturate and record != 'bits': raise ValueError('coven error: saturation requires record mode `bits`.')
+  if test_contexts and engine != 'settrace':
+    raise ValueError('coven error: automatic test contexts require the settrace engine.')
+  code_edges = CodeEdges(record)
+  import threading
+  code_edges.prev_tracers = (gettrace(), threading._trace_hook) # restored by `uninstall_trace`.
+  if engine == 'settrace':
+    sample_call = call_sampler(sample) if (sample is not None and sample < 1 and sample_window is None) else None
+    install_settrace(code_target_filter(targets, dbg), code_edges, record, saturate, sample_call, dbg,
+      test_contexts=test_contexts, sample_window=(None if sample_window is None else (sample, sample_window)))
+  elif engine == 'probes':
+    is_main_targeted = '__main__' in targets
+    finder = TargetImportFinder(targets, main_file=(main_file if is_main_targeted else None),
+      main_module=(main_module if is_main_targeted else None))
+    install_probes(finder, code_edges, dbg)
+    sys.meta_path.insert(0, finder)
+  else: raise ValueError(f'coven error: unknown tracing engine: {engine!r}')
+  return code_edges
+
+
+def uninstall_trace(code_edges):
+  '''
+  Stop tracing, restoring the tracer and `threading` trace hook that were installed before `install_trace`,
+  then merge the edges traced by other threads into `code_edges`.
+  '''
+  for finder in [f for f in sys.meta_path if isinstance(f, TargetImportFinder)]:
+    finder.rewrite = None # loaders that were already wrapped may still register code.
+    sys.meta_path.remove(finder)
+  if code_edges.stop_sampling: code_edges.stop_sampling()
+  import threading
+  prev_tracer, prev_thread_hook = code_edges.prev_tracers
+  threading.settrace(prev_thread_hook)
+  settrace(prev_tracer)
+  code_edges.merge_shards()
+
+
+class CodeEdges(defaultdict):
+  '''
+  The `code_edges` dictionary populated by the tracing engines.
+  The thread that installs the trace records into this dictionary directly;
+  every other thread records into its own shard, so that tracers never contend for (or lock) the edge containers,
+  which matters on free-threaded interpreters where many threads run target code simultaneously.
+  Shards are created under a lock, once per thread, and must be merged with `merge_shards` before the edges are read.
+  Merging is idempotent, so a snapshot can be taken while other threads are still tracing.
+  Code instrumented by the probes engine records into a per-code bitmap of probe sites instead;
+  merging translates the hit sites of each into its edge bitmap.
+  When recording dynamic contexts, the edges of each context are set aside when the context changes (see `set_context`),
+  and `finish_contexts` restores their union as the contents of the dictionary.
+  '''
+
+  def __init__(self, record):
+    from threading import Lock
+    super().__init__(None if record == 'bits' else set)
+    self.shards = []
+    self.shards_lock = Lock()
+    self.probes = [] # (code, hits, site_ids, n) for each instrumented code object; see `install_probes`.
+    self.context = '' # The label of the current dynamic context; '' is the default context.
+    self.context_edges = None # Maps context labels to the edges set aside for them, if recording contexts.
+    self.stop_sampling = None # Stops windowed sampling, if installed; see `install_sample_windows`.
+    self.prev_tracers = (None, None) # The tracer and `threading` trace hook that `install_trace` replaced.
+
+  def add_probes(self, code, hits, site_ids, n):
+    with self.shards_lock:
+      self.probes.append((code, hits, site_ids, n))
+
+  def new_shard(self):
+    shard = defaultdict(self.default_factory)
+    with self.shards_lock:
+      self.shards.append(shard)
+    return shard
+
+  def merge_shards(self):
+    with self.shards_lock:
+      shards = list(self.shards)
+    for shard in shards:
+      for code, edges in list(shard.items()): # Copy, because the owning thread may add entries concurrently.
+        merge_edges(self, code, edges)
+    with self.shards_lock:
+      probes = list(self.probes)
+    for code, hits, site_ids, n in probes:
+      if not any(hits): continue
+      bits = self.get(code)
+      if bits is None: bits = self[code] = bytearray(n + 1)
+      for site, hit in enumerate(hits):
+        if not hit: continue
+        for i in site_ids[site]: bits[i] = 1
+
+  def record_contexts(self, enabled=True):
+    'Start (or stop) recording the edges of each dynamic context separately.'
+    self.context = ''
+    self.context_edges = {} if enabled else None
+
+  def set_context(self, label):
+    '''
+    Set aside the edges recorded so far for the current context, and record subsequent edges for the context `label`.
+    This does nothing unless recording contexts.
+    Edges that other threads record while the context changes may be attributed to either context.
+    '''
+    if self.context_edges is None or label == self.context: return
+    self.set_aside_context()
+    self.context = label
+
+  def set_aside_context(self):
+    self.merge_shards()
+    context_edges = self.context_edges.setdefault(self.context, {})
+    for code, edges in list(self.items()):
+      if any(edges): merge_edges(context_edges, code, edges) # copies new containers, so `reset` does not clear them.
+    self.reset()
+
+  def finish_contexts(self):
+    'Set aside the current context, then restore the union of the edges of all contexts to this dictionary.'
+    self.set_aside_context()
+    for context_edges in self.context_edges.values():
+      for code, edges in context_edges.items():
+        merge_edges(self, code, edges)
+
+  def codes(self):
+    'All code objects traced by any thread.'
+    with self.shards_lock:
+      return set(self).union(*self.shards)
+
+  def reset(self):
+    'Clear all edges in place, because the tracers hold references to the edge containers.'
+    with self.shards_lock:
+      shards = list(self.shards)
+      probes = list(self.probes)
+    for edges in chain.from_iterable(list(d.values()) for d in [self, *shards]):
+      if is_edge_bits(edges): edges[:] = bytes(len(edges))
+      else: edges.clear()
+    for _, hits, _, _ in probes:
+      hits[:] = bytes(len(hits))
+
+
+def test_context_label(frame):
+  '''
+  The dynamic context label for a call to a test function in `frame`: its module and qualified name.
+  Before Python 3.11, code objects lack a qualified name, so the class of a method is inferred from `self`.
+  '''
+  code = frame.f_code
+  qualname = getattr(code, 'co_qualname', None)
+  if qualname is None:
+    is_method = code.co_argcount and code.co_varnames[0] == 'self'
+    qualname = f'{type(frame.f_locals["self"]).__name__}.{code.co_name}' if is_method else code.co_name
+  return f'{frame.f_globals.get("__name__", "?")}.{qualname}'
+
+
+active_code_edges = None # The `CodeEdges` of `trace_cmd` while it records dynamic contexts; see `set_context`.
 
-  code_edges = defaultdict(set)
-  file_name_filter = {}
+
+def set_context(label):
+  '''
+  Record the edges traced from now on for the dynamic context `label`, e.g. the name of the test that is about to run.
+  Traced code can call this as `coven.set_context(label)`; it does nothing unless coven is recording contexts
+  (see `-contexts-db`). Contexts are global to the process, rather than per thread.
+  '''
+  if active_code_edges is not None: active_code_edges.set_context(label)
+
+
+class Session:
+  '''
+  An in-process coverage session, for embedding coven in a program that is already running, e.g. a test runner,
+  which can then run many scripts or tests under coverage without starting a coven process for each.
+  `targets` are module names or paths, as for `-targets`; the remaining options are those of `install_trace`.
+  Code is traced between `start` and `stop`, which may alternate; the edges of every interval accumulate.
+  As with `trace_cmd`, the <module> code of targets that are already imported when the session starts is not traced,
+  and with the probes engine, such targets are not traced at all.
+  A session uses the process-wide tracer (or import hook, for the probes engine),
+  so it cannot start while another session, tracer or coven trace is installed;
+  the `threading` trace hook of the host is restored when the session stops.
+  As a context manager, the session starts on entry and stops on exit.
+  '''
+
+  def __init__(self, targets, engine='settrace', record='sets', saturate=False, sample=None, dbg=None):
+    self.targets = expand_targets(targets)
+    if not self.targets: raise ValueError('coven error: a session requires at least one target.')
+    self.options = dict(dbg=dbg, engine=engine, record=record, saturate=saturate, sample=sample)
+    self.sample_rate = sample or 1.0
+    self.code_edges = None # The `CodeEdges` of the current interval, while running.
+    self.path_code_edges = defaultdict(dict) # The edges of the stopped intervals, grouped by absolute path.
+    self.target_path_sets = defaultdict(set) # The paths from which each target was traced.
+
+  def __enter__(self): return self.start()
+
+  def __exit__(self, *exc_info): self.stop()
+
+  def start(self):
+    'Start tracing; return the session.'
+    if self.code_edges is not None: raise ValueError('coven error: the session is already running.')
+    if active_sessions or any(isinstance(f, TargetImportFinder) for f in sys.meta_path):
+      raise ValueError('coven error: cannot start a session while another coven session or trace is running.')
+    if sys.gettrace() is not None:
+      raise ValueError('coven error: cannot start a session while another tracer is installed.')
+    self.code_edges = install_trace(self.targets, **self.options)
+    active_sessions.add(self)
+    return self
+
+  def stop(self):
+    'Stop tracing, and add the edges traced since `start` to the session.'
+    if self.code_edges is None: raise ValueError('coven error: the session is not running.')
+    code_edges = self.code_edges
+    self.code_edges = None
+    active_sessions.discard(self)
+    uninstall_trace(code_edges)
+    add_path_code_edges(self.path_code_edges, code_edges)
+    self.update_target_paths()
+
+  def snapshot(self):
+    '''
+    Return a copy of the edges traced so far, including those of the current interval if the session is running,
+    as a `path_code_edges` dictionary, which maps absolute paths to dictionaries of code objects to edges.
+    '''
+    path_code_edges = defaultdict(dict)
+    for path, code_edges in self.path_code_edges.items():
+      add_path_code_edges(path_code_edges, code_edges)
+    if self.code_edges is not None:
+      self.code_edges.merge_shards() # idempotent, so `stop` merges the same shards again.
+      add_path_code_edges(path_code_edges, self.code_edges)
+    return dict(path_code_edges)
+
+  def update_target_paths(self):
+    'Add the paths of the target modules that are currently imported.'
+    main = sys.modules.get('__main__')
+    main_path = getattr(main, '__file__', None)
+    main_path = abs_path(main_path) if main_path else None
+    for target, path in trace_target_paths(self.targets, main_path=main_path, dbg=self.options['dbg']).items():
+      paths = self.target_path_sets[target] # materialize the set; leave empty for None case.
+      if path is not None: paths.add(abs_path(path))
+
+  def save(self, path, format='indexed', compression='zlib'):
+    '''
+    Write the edges traced so far to the trace file at `path`,
+    which can be reported or coalesced with other traces by `coven -coalesce`.
+    '''
+    self.update_target_paths()
+    target_paths = { t : sorted(paths) for t, paths in self.target_path_sets.items() }
+    write_coverage(output_path=path, target_paths=target_paths, path_code_edges=self.snapshot(),
+      sample_rate=self.sample_rate, format=format, compression=compression)
+
+  def merge(self, other):
+    'Add the targets and the edges traced so far by the `other` session to this one; return this session.'
+    other.update_target_paths()
+    self.targets.update(other.targets)
+    for target, paths in other.target_path_sets.items():
+      self.target_path_sets[target].update(paths)
+    for path, code_edges in other.snapshot().items():
+      add_path_code_edges(self.path_code_edges, code_edges)
+    self.sample_rate = min(self.sample_rate, other.sample_rate)
+    return self
+
+
+active_sessions = set() # The running sessions; at most one, because tracing is process-wide.
+
+
+def add_path_code_edges(path_code_edges, code_edges):
+  'Merge copies of the traced edges in `code_edges` into `path_code_edges`, grouped by the absolute paths of the code.'
+  for code, edges in list(code_edges.items()):
+    if any(edges): merge_edges(path_code_edges[abs_path(code.co_filename)], code, edges)
+
+
+# Contexts database.
+# Each row of `edge` is an edge (or for line traces, just a line) that a dynamic context traced.
+# `code_name` and `code_line` (the first line) identify the code object within the file, to which the offsets belong.
+contexts_db_schema = '''
+CREATE TABLE IF NOT EXISTS context (id INTEGER PRIMARY KEY, label TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS file (id INTEGER PRIMARY KEY, path TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS edge (
+  context_id INTEGER NOT NULL REFERENCES context (id),
+  file_id INTEGER NOT NULL REFERENCES file (id),
+  line INTEGER NOT NULL,
+  code_name TEXT NOT NULL,
+  code_line INTEGER NOT NULL,
+  src INTEGER,
+  dst INTEGER);
+CREATE INDEX IF NOT EXISTS edge_file_line ON edge (file_id, line);
+CREATE INDEX IF NOT EXISTS edge_context ON edge (context_id);
+'''
+
+
+def write_contexts_db(db_path, context_edges):
+  '''
+  Write the edges of each context (a dictionary mapping labels to `code_edges` dictionaries)
+  to the SQLite database at `db_path`, creating it if necessary.
+  The rows of each context replace any that a previous run recorded for the same label,
+  so that the database accumulates the latest run of every context.
+  '''
+  import sqlite3
+  db = sqlite3.connect(db_path)
+  try:
+    with db:
+      db.executescript(contexts_db_schema)
+      file_id = db_file_ids(db)
+      for label, code_edges in sorted(context_edges.items()):
+        db.execute('INSERT OR IGNORE INTO context (label) VALUES (?)', (label,))
+        context_id, = db.execute('SELECT id FROM context WHERE label = ?', (label,)).fetchone()
+        db.execute('DELETE FROM edge WHERE context_id = ?', (context_id,))
+        rows = []
+        for code, edges in code_edges.items():
+          fid = file_id(abs_path(code.co_filename))
+          if is_edge_bits(edges):
+            req, _ = crawl_code_insts(path=code.co_filename, code=code, dbg_name=None)
+            edges = edges_from_bits(edges, req)
+          for edge in edges:
+            if isinstance(edge, int): rows.append((context_id, fid, edge, code.co_name, code.co_firstlineno, None, None))
+            else: rows.append((context_id, fid, edge[2], code.co_name, code.co_firstlineno, edge[0], edge[1]))
+        db.executemany('INSERT INTO edge VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+  finally:
+    db.close()
+
+
+def db_file_ids(db):
+  'Return a function that maps paths to the ids of their rows in the `file` table of `db`, inserting rows as needed.'
+  file_ids = {}
+  def file_id(path):
+    try: return file_ids[path]
+    except KeyError: pass
+    db.execute('INSERT OR IGNORE INTO file (path) VALUES (?)', (path,))
+    id, = db.execute('SELECT id FROM file WHERE path = ?', (path,)).fetchone()
+    file_ids[path] = id
+    return id
+  return file_id
+
+
+def query_line_contexts(db_path, path, line):
+  'Return the sorted labels of the contexts that traced any edge on `line` of `path`, from the contexts database.'
+  import sqlite3
+  if not os.path.isfile(db_path): exit(f'coven error: contexts database not found: {db_path}')
+  db = sqlite3.connect(db_path)
+  try:
+    rows = db.execute('SELECT DISTINCT context.label FROM edge '
+      'JOIN file ON file.id = edge.file_id JOIN context ON context.id = edge.context_id '
+      'WHERE file.path = ? AND edge.line = ? ORDER BY context.label', (abs_path(path), line)).fetchall()
+  except sqlite3.DatabaseError as e: exit(f'coven error: could not query contexts database: {db_path}: {e}')
+  finally: db.close()
+  return [label for label, in rows]
+
+
+def code_target_filter(targets, dbg):
+  '''
+  Return a predicate that decides whether a code object belongs to one of the target modules.
+  Decisions are cached by filename, so the module lookup happens once per file.
+  Coven's own code is never targeted, even when it runs as `__main__`,
+  because parts of it (e.g. fork and thread handlers) run while the trace is installed.
+  '''
+  file_name_filter = {__file__: False}
+  module_for_file = file_module_index()
 
   def is_code_targeted(code):
-    module = getmodule(code)
+    module = module_for_file(code.co_filename)
     if module is None: return False # probably a python builtin; not traceable.
     is_target = (module.__name__ in targets)
     # note: the module filename may not equal the code filename.
@@ -160,42 +1053,846 @@ def install_trace(targets, dbg):
       errSL(f'coven.is_code_targeted: {code.co_filename}:{code.co_name} -> {module.__name__} -> {is_target}')
     return is_target
 
-  def coven_global_tracer(g_frame, g_event, _g_arg_is_none):
-    code = g_frame.f_code
-    #if dbg == code.co_name: errSL('GTRACE:', g_event, g_frame.f_lineno, code.co_name)
-    if g_event != 'call': return None
+  def is_code_targeted_cached(code):
     path = code.co_filename
     try:
-      is_target = file_name_filter[path]
+      return file_name_filter[path]
     except KeyError:
       is_target = is_code_targeted(code)
       file_name_filter[path] = is_target
+      return is_target
 
-    if not is_target: return None # do not trace this scope.
-
-    # set tracing mode.
-    g_frame.f_trace_lines = False
-    g_frame.f_trace_opcodes = True
-
-    # the local tracer lives only as long as execution continues within the code block.
-    # for a generator, this can be less than the lifetime of the frame,
-    # which is saved and restored when resuming from a `yield`.
-    edges = code_edges[code]
-    prev_off  = OFF_BEGIN
-    def coven_local_tracer(frame, event, arg):
-      nonlocal prev_off
-      line = frame.f_lineno
-      off = frame.f_lasti
-      #errSL(f'LTRACE: {code.co_name} {event[:6]} {prev_off:2} -> {off:2}; line:{line}')
-      if event == 'opcode':
-        edges.add((prev_off, off, line))
-        prev_off = off
-      return coven_local_tracer # local tracer keeps itself in place during its local scope.
-
-    return coven_local_tracer # global tracer installs a new local tracer for every call.
-
-  settrace(coven_global_tracer)
-  return code_edges
+  return is_code_targeted_cached
+
+
+class TargetImportFinder:
+  '''
+  A `sys.meta_path` finder for `-engine probes`.
+  It finds nothing itself; when the remaining finders find a target module,
+  it wraps the loader's `get_code` so that the module's code is registered just before the module executes.
+  The `__main__` code is run by runpy rather than imported, so `run_main` registers the code of `main_file` itself.
+  A `main_module` (i.e. `-m`) is found through the finders by runpy, so it is registered like an imported target;
+  for a package, only its `__main__` submodule is the main code.
+  Target modules that were imported before installation (i.e. by coven itself) are not traced.
+  `install_probes` sets `rewrite`, which replaces the registered module code with its instrumented copy; see `run_main`.
+  '''
+
+  def __init__(self, targets, main_file, main_module=None):
+    self.targets = targets
+    self.main_file = main_file
+    self.main_names = () if main_module is None else (main_module, main_module + '.__main__')
+    self.rewrite = None # Set by `install_probes` to a function that returns instrumented module code.
+
+  def find_spec(self, name, path, target=None):
+    is_main = name in self.main_names
+    if not (is_main or name in self.targets): return None
+    for finder in sys.meta_path:
+      if finder is self: continue
+      find_spec = getattr(finder, 'find_spec', None)
+      if find_spec is None: continue
+      spec = find_spec(name, path, target)
+      if spec is not None: break
+    else: return None
+    if is_main and name not in self.targets and spec.submodule_search_locations is not None:
+      return spec # the package of a main `__main__` submodule, which is not itself the main code.
+    get_code = getattr(spec.loader, 'get_code', None)
+    if get_code is None: return spec # e.g. an extension module, which is not traceable.
+
+    def get_code_registered(fullname):
+      code = get_code(fullname)
+      if code is not None: code = self.register(code)
+      return code
+
+    spec.loader.get_code = get_code_registered # shadows the method for this loader instance only.
+    return spec
+
+  def register(self, module_code):
+    'Return the code to execute: `module_code` itself, or its instrumented copy if `rewrite` is set.'
+    return self.rewrite(module_code) if self.rewrite else module_code
+
+
+def file_module_index():
+  '''
+  Return a function that maps a code filename to the module loaded from that file, or None.
+  This replaces `inspect.getmodule`, which rescans all of `sys.modules` and stats files whenever its cache misses.
+  The index is keyed by absolute (and real) path, and is updated incrementally.
+  On a miss, only the entries appended to `sys.modules` since the previous update are indexed, relying on dict order.
+  If the filename is still missing, a full pass catches entries that were replaced in place
+  (e.g. by runpy for `__main__`, or by multiprocessing for `__mp_main__`);
+  that pass only compares module identities, and only happens for filenames that belong to no module,
+  which are few (e.g. '<string>'), and each is decided once by the caller's cache.
+  '''
+  index = {} # Maps absolute and real paths to modules.
+  indexed = {} # Maps module names to the modules as of their indexing.
+  scanned_count = 0
+
+  def add(name, module):
+    if indexed.get(name) is module: return
+    indexed[name] = module
+    path = getattr(module, '__file__', None)
+    if not isinstance(path, str): return # builtin, frozen or namespace module.
+    path = abs_path(path)
+    index[path] = module
+    real_path = os.path.realpath(path)
+    if real_path != path: index[real_path] = module
+
+  def update(full):
+    nonlocal scanned_count
+    modules = sys.modules
+    if full or len(modules) < scanned_count: scanned_count = 0
+    items = list(islice(modules.items(), scanned_count, None))
+    scanned_count += len(items)
+    for name, module in items: add(name, module)
+
+  def lookup(path):
+    return index.get(path) or index.get(os.path.realpath(path))
+
+  def module_for_file(file_name):
+    path = abs_path(file_name)
+    try: return index[path]
+    except KeyError: pass
+    update(full=False)
+    module = lookup(path)
+    if module is None:
+      update(full=True)
+      module = lookup(path)
+    return module
+
+  return module_for_file
+
+
+def call_sampler(rate):
+  '''
+  Return a predicate that decides whether to trace a call to a code object, so that `rate` of all calls are traced.
+  The first call to each code object is always traced, so that rarely called code is seen.
+  Subsequent calls are chosen at random rather than at a fixed stride,
+  so that periodic call patterns do not alias, and so that separate sampled runs coalesce to better coverage.
+  '''
+  from random import random
+  seen = set()
+
+  def sample_call(code):
+    if code in seen: return random() < rate
+    seen.add(code)
+    return True
+
+  return sample_call
+
+
+def install_settrace(is_code_targeted, code_edges, record, saturate, sample_call, dbg, test_contexts=False,
+ sample_window=None):
+  '''
+  Install a tracer that records into `code_edges` for the current thread,
+  and a `threading` trace hook that installs a tracer with its own shard (see `CodeEdges`) in each new thread.
+  Threads that are already running are not traced.
+  If `sample_window` is a (rate, seconds) pair, the tracer is instead switched on and off by `install_sample_windows`,
+  and other threads are not traced.
+  If `test_contexts` is set, the global tracer also watches for calls to test functions:
+  the outermost test call switches `code_edges` to the context of the test, and restores the previous context on return.
+  '''
+  import threading
+  edge_ids = {} # Maps code to the results of `code_edge_ids`, for record='bits'; shared by all threads.
+  saturated = set() # Code objects that are no longer traced, by any thread.
+  test_frame = None # The frame of the test function that set the current context.
+
+  def thread_tracer(shard):
+    'Return a global tracer that records into `shard`.'
+    code_bits = {} # Maps code to its `bits_tracer`, for record='bits'.
+
+    def coven_global_tracer(g_frame, g_event, _g_arg_is_none):
+      code = g_frame.f_code
+      #if dbg == code.co_name: errSL('GTRACE:', g_event, g_frame.f_lineno, code.co_name)
+      if g_event != 'call': return None
+      if code in saturated: return None
+      if not is_code_targeted(code): return None # do not trace this scope.
+      if sample_call is not None and not sample_call(code): return None
+
+      if record == 'lines': return lines_tracer(code) # frames trace lines by default.
+
+      # set tracing mode.
+      g_frame.f_trace_lines = False
+      g_frame.f_trace_opcodes = True
+
+      if record == 'bits':
+        try: return code_bits[code]()
+        except KeyError: return bits_tracer(code)()
+
+      # the local tracer lives only as long as execution continues within the code block.
+      # for a generator, this can be less than the lifetime of the frame,
+      # which is saved and restored when resuming from a `yield`.
+      edges = shard[code]
+      prev_off  = OFF_BEGIN
+      def coven_local_tracer(frame, event, arg):
+        nonlocal prev_off
+        line = frame.f_lineno
+        off = frame.f_lasti
+        #errSL(f'LTRACE: {code.co_name} {event[:6]} {prev_off:2} -> {off:2}; line:{line}')
+        if event == 'opcode':
+          edges.add((prev_off, off, line))
+          prev_off = off
+        return coven_local_tracer # local tracer keeps itself in place during its local scope.
+
+      return coven_local_tracer # global tracer installs a new local tracer for every call.
+
+    def lines_tracer(code):
+      edges = shard[code]
+      def coven_local_lines_tracer(frame, event, arg):
+        if event == 'line': edges.add(frame.f_lineno)
+        return coven_local_lines_tracer
+      return coven_local_lines_tracer
+
+    def bits_tracer(code):
+      '''
+      Return a function that returns a new local tracer for each activation of `code`,
+      the same as coven_local_tracer, except that each edge is looked up by its offsets as an id (see `code_edge_ids`),
+      and recorded as a byte in the bitmap.
+      The tables and bitmap are bound once per code, so that each call only creates the local tracer.
+      If `saturate` is set, each newly recorded edge checks whether the bitmap is complete;
+      if so, the code is saturated, and the local tracer removes itself from the frame.
+      '''
+      try: table = edge_ids[code]
+      except KeyError: table = edge_ids[code] = code_edge_ids(code, dbg)
+      slots, other_rows, dst_ids, groups, n = table
+      bits = shard[code] = bytearray(n + 1)
+      unexpected = n
+
+      def start_bits_tracer():
+        prev_off = OFF_BEGIN
+        def coven_local_bits_tracer(frame, event, arg):
+          nonlocal prev_off
+          if event == 'opcode':
+            off = frame.f_lasti
+            if slots[off] == prev_off: i = slots[off + 1]
+            else:
+              try: i = other_rows[off][prev_off]
+              except KeyError: i = dst_ids.get(off, unexpected)
+            prev_off = off
+            if i >= 0:
+              if bits[i]: return coven_local_bits_tracer
+              bits[i] = 1
+            elif i != NO_EDGE_ID:
+              line_ids, group_ids = groups[-2 - i]
+              for i in line_ids.get(frame.f_lineno, group_ids): bits[i] = 1
+            else: return coven_local_bits_tracer
+            # A new edge may have been recorded.
+            if saturate and is_bits_saturated(bits): return saturate_frame(frame)
+          return coven_local_bits_tracer
+        return coven_local_bits_tracer
+
+      def saturate_frame(frame):
+        'Stop tracing `code`: calls in any thread are no longer traced, and neither is the rest of this activation.'
+        saturated.add(code)
+        code_bits.pop(code, None)
+        if dbg: errSL(f'coven: saturated: {code.co_filename}:{code.co_name}')
+        frame.f_trace_opcodes = False
+        frame.f_trace = None # returning None does not clear the local tracer of the frame in 3.7.
+        return None
+
+      code_bits[code] = start_bits_tracer
+      return start_bits_tracer
+
+    if not test_contexts: return coven_global_tracer
+
+    def coven_global_test_context_tracer(g_frame, g_event, g_arg):
+      tracer = coven_global_tracer(g_frame, g_event, g_arg)
+      if g_event == 'call' and test_frame is None and g_frame.f_code.co_name.startswith('test'):
+        return test_context_tracer(g_frame, tracer)
+      return tracer
+
+    return coven_global_test_context_tracer
+
+  def test_context_tracer(frame, tracer):
+    '''
+    Switch to the context of the test function called in `frame`, and return a local tracer that delegates to `tracer`,
+    if the test code is itself traced, and that restores the previous context when the test returns.
+    '''
+    nonlocal test_frame
+    test_frame = frame
+    prev_context = code_edges.context
+    code_edges.set_context(test_context_label(frame))
+    if tracer is None: frame.f_trace_lines = False # only the return event is needed.
+
+    def coven_test_context_tracer(frame, event, arg):
+      nonlocal tracer, test_frame
+      if tracer is not None: tracer = tracer(frame, event, arg)
+      if event == 'return':
+        test_frame = None
+        code_edges.set_context(prev_context)
+      return coven_test_context_tracer
+
+    return coven_test_context_tracer
+
+  def coven_thread_start(frame, event, arg):
+    'Runs as the first trace event of each new thread, and replaces itself with a tracer for a new shard.'
+    tracer = thread_tracer(code_edges.new_shard())
+    settrace(tracer)
+    return tracer(frame, event, arg)
+
+  if sample_window:
+    code_edges.stop_sampling = install_sample_windows(thread_tracer(code_edges), *sample_window)
+    return
+  settrace(thread_tracer(code_edges))
+  threading.settrace(coven_thread_start)
+
+
+def install_sample_windows(tracer, rate, window):
+  '''
+  Trace the main thread with `tracer` for `window` seconds of process CPU time,
+  then stop tracing for as long as it takes for the traced windows to be `rate` of the CPU time, and repeat.
+  A `SIGVTALRM` interval timer switches between the two, so untraced intervals cost nothing,
+  and the overhead is at most rate / (1 - rate) however slow the tracer is.
+  Closing a window clears the local tracers of the frames on the stack, so an activation is traced from its call
+  (or generator resumption) until the window closes; a later window only traces later calls.
+  Forked children restart the timer, which is not inherited.
+  Return a function that stops the timer and restores the previous signal handler.
+  '''
+  import signal
+  gap = window * (1 - rate) / rate
+  coven_filename = install_sample_windows.__code__.co_filename
+
+  stale_frame = None # A frame whose local tracer may have been reinstalled after its window closed.
+
+  def coven_sample_window(_signum, frame):
+    nonlocal stale_frame
+    if gettrace() is None: # open a window.
+      if stale_frame is not None: stale_frame.f_trace = None
+      stale_frame = None
+      settrace(tracer)
+      signal.setitimer(signal.ITIMER_VIRTUAL, window)
+      return
+    settrace(None)
+    # If interrupted inside a tracer, then the tracer returns a local tracer for the traced frame that called it,
+    # which is reinstalled after this handler clears it; that frame must not resume tracing with a stale offset.
+    f = frame
+    while f is not None and f.f_code.co_filename == coven_filename: f = f.f_back
+    if f is not frame: stale_frame = f
+    while frame is not None:
+      frame.f_trace = None
+      frame = frame.f_back
+    signal.setitimer(signal.ITIMER_VIRTUAL, gap)
+
+  is_stopped = False
+
+  def restart():
+    if not is_stopped: signal.setitimer(signal.ITIMER_VIRTUAL, window if gettrace() else gap)
+
+  prev_handler = signal.signal(signal.SIGVTALRM, coven_sample_window)
+  os.register_at_fork(after_in_child=restart)
+  settrace(tracer)
+  signal.setitimer(signal.ITIMER_VIRTUAL, window)
+
+  def stop():
+    nonlocal is_stopped
+    is_stopped = True
+    signal.setitimer(signal.ITIMER_VIRTUAL, 0)
+    signal.signal(signal.SIGVTALRM, prev_handler)
+
+  return stop
+
+
+def install_probes(finder, code_edges, dbg):
+  '''
+  Collect edges without tracing: as each target module is imported (or the main code is run; see `run_main`),
+  `finder` rewrites its code objects so that they record their own edges.
+  Each probe is a single bytearray store that marks a probe site as hit; sites are placed so that each one
+  witnesses a set of edges exactly (see `probe_plan`), and `CodeEdges.merge_shards` translates hit sites into the
+  edge bitmap of the original code object, so that traces and reports are the same as for `-record bits`.
+  Code that cannot be probed exactly (see `probe_plan`) is left as is, along with its nested code,
+  and is traced instead by a settrace tracer that is only installed once such code is first imported;
+  threads that were already running at that point do not trace it.
+  '''
+  fallback_codes = set()
+
+  def fall_back(code):
+    if not fallback_codes:
+      install_settrace(fallback_codes.__contains__, code_edges, 'bits', False, None, dbg)
+    fallback_codes.update(visit_nodes(start_nodes=[code], visitor=sub_codes))
+    if dbg: errSL(f'coven.probes: tracing instead: {code.co_filename}:{code.co_name}')
+
+  def rewrite(code):
+    plan = probe_plan(code, dbg)
+    if plan is None:
+      fall_back(code)
+      return code
+    consts = [rewrite(c) if isinstance(c, CodeType) else c for c in code.co_consts]
+    hits = ProbeHits(len(plan.site_ids))
+    code_edges.add_probes(code, hits, plan.site_ids, plan.n)
+    if dbg: errSL(f'coven.probes: instrumenting {code.co_filename}:{code.co_name}: {len(hits)} sites')
+    return assemble_probes(code, plan, consts, hits)
+
+  finder.rewrite = rewrite
+
+
+class ProbeHits(bytearray):
+  '''
+  The hit flags of the probe sites of an instrumented code object, which holds them as a constant.
+  Code objects hash their constants, so this is hashable by identity, lest instrumented code become unhashable.
+  '''
+  __hash__ = object.__hash__
+
+
+NO_EDGE_ID = -1 # The id of optional edges in `EdgeIds` tables.
+
+EdgeIds = namedtuple('EdgeIds', 'slots other_rows dst_ids groups n')
+
+shared_ints = {} # Int objects shared by all `EdgeIds` slots; most offsets and ids are too large for CPython's small ints.
+
+
+def code_edge_ids(code, dbg):
+  '''
+  Assign a dense integer id to every required (src, dst, line) edge of `code`, in sorted order.
+  Return an `EdgeIds`, with which the tracer identifies each traced edge by the offsets it already has,
+  as a single int: the id that the edge matches in `calculate_coverage`;
+  NO_EDGE_ID for optional edges, which never contribute to coverage;
+  or, for the few edges that match several ids, or different ids depending on the line in effect,
+  the group `-2 - k`, which matches the ids of groups[k].
+  * slots is a list as long as the bytecode: almost every instruction is reached from a single source,
+    so each destination offset `dst` (always even) holds that source in slots[dst], and its int in slots[dst + 1].
+    A list is both compact and fast to index.
+  * other_rows maps the remaining edges, as nested dictionaries dst -> src, to their ints.
+  * dst_ids maps exception handler destinations to ints,
+    for raised edges whose source is an arbitrary instruction.
+  * groups is a list of (line_ids, ids) pairs: a group matches the tuple of ids of the line in effect in line_ids,
+    or else ids.
+  * n is the number of ids.
+  An edge that is inferred on a single line matches its ids whatever the line in effect, as probes do.
+  A bitmap has n + 1 bytes; the final byte (id n) flags that some unexpected edge was traced.
+  '''
+  req, opt = crawl_code_insts(path=code.co_filename, code=code, dbg_name=dbg)
+  ids = {}
+  edge_ids = defaultdict(list)
+  for i, (edge, line) in enumerate(req_edge_lines(req)):
+    ids[(edge, line)] = i
+    edge_ids[edge].append(i)
+  raise_ids = { edge[1] : tuple(i) for edge, i in edge_ids.items() if edge[0] == OFF_RAISED }
+  # The following mirrors the matching precedence in calculate_coverage:
+  # required edges, then required exception destinations, then optional edges and exception destinations.
+  edge_line_ids = defaultdict(dict)
+  for edge, lines in opt.items():
+    for line in lines: edge_line_ids[edge][line] = raise_ids.get(edge[1], ())
+  for (edge, line), i in ids.items(): edge_line_ids[edge][line] = (i,)
+  dst_tuples = { edge[1] : () for edge in opt if edge[0] == OFF_RAISED }
+  dst_tuples.update(raise_ids)
+  n = len(ids)
+  groups = []
+  def edge_id(line_ids, ids):
+    'The int for an edge that matches the ids of the line in effect in `line_ids`, or else `ids`.'
+    if not line_ids:
+      if not ids: return NO_EDGE_ID
+      if len(ids) == 1: return ids[0]
+    groups.append((line_ids or {}, ids))
+    return -1 - len(groups) # i.e. -2 - k for groups[k].
+  slots = [None, NO_EDGE_ID] * (len(code.co_code) // 2)
+  other_rows = {}
+  # Fall-through edges (from the previous instruction) take the list slots first, because they are the most common.
+  for (src, dst), line_ids in sorted(edge_line_ids.items(), key=lambda item: item[0][0] != item[0][1] - 2):
+    if dst < 0: continue # fake destinations are never traced.
+    if len(set(line_ids.values())) == 1: i = edge_id(None, next(iter(line_ids.values())))
+    else: i = edge_id(line_ids, dst_tuples.get(dst, (n,)))
+    if slots[dst] is None:
+      slots[dst] = shared_ints.setdefault(src, src)
+      slots[dst + 1] = shared_ints.setdefault(i, i)
+    else: other_rows.setdefault(dst, {})[src] = i
+  dst_ids = { dst : edge_id(None, ids) for dst, ids in dst_tuples.items() }
+  return EdgeIds(slots, other_rows, dst_ids, groups, n)
+
+
+def req_edge_lines(req):
+  'The sorted (edge, line) pairs of a required edges dictionary; the index of each pair is its id.'
+  return sorted((edge, line) for edge, lines in req.items() for line in lines)
+
+
+def is_edge_bits(edges): return isinstance(edges, (bytes, bytearray))
+
+
+def is_line_set(edges):
+  '''
+  True if `edges` holds traced lines (record='lines') rather than edge triples.
+  Line sets are only merged with edges when coalescing line and edge traces together for `-lines`;
+  such sets are mixed, but are never written.
+  '''
+  return any(isinstance(e, int) for e in edges)
+
+
+def is_bits_saturated(bits):
+  'True if every required edge in the bitmap has been traced; the final (unexpected) byte is ignored.'
+  return bits.find(0, 0, len(bits) - 1) == -1
+
+
+def edges_from_bits(bits, req):
+  'Convert an edge bitmap back to a set of edge triples, for merging with edge sets.'
+  return { (edge[0], edge[1], line) for i, (edge, line) in enumerate(req_edge_lines(req)) if bits[i] }
+
+
+def bits_matched_edges(bits, req):
+  'Map each required edge whose id is set in the bitmap `bits` to its matched lines, as `calculate_coverage` does.'
+  matched = defaultdict(set)
+  for i, (edge, line) in enumerate(req_edge_lines(req)):
+    if bits[i]: matched[edge].add(line)
+  return matched
+
+
+ProbeInst = namedtuple('ProbeInst', 'off op arg argval stack')
+
+ProbePlan = namedtuple('ProbePlan', 'insts entry_sites targets trampolines site_ids n')
+
+
+def probe_plan(code, dbg):
+  '''
+  Plan the probes that record the edges of `code` for the probes engine, or return None if they cannot be exact.
+  The plan follows the runtime control flow between instructions (offsets account for EXTENDED_ARG, as in crawl_code_insts).
+  An instruction that never raises and has a single successor always takes its edge to that successor,
+  so that edge is folded into the probe sites of every edge that reaches the instruction (see `probe_closure`).
+  Each remaining edge that implies any edge ids gets its own site:
+  * an edge that reaches an instruction by falling through (or by starting or resuming the frame) gets a probe
+    immediately before the instruction, which every jump to the instruction skips;
+  * a conditional jump (or FOR_ITER exit) gets a trampoline, appended to the code, that probes and jumps to the destination;
+  * entry to an exception handler gets a trampoline that is the new destination of the SETUP instruction.
+  If an instruction has only one incoming edge, its probe is placed before it and the edge's jump targets the probe.
+  The ids of each edge are those that `code_edge_ids` would assign to the traced edge, whose line is the `f_lineno` in effect.
+  That line only changes at the start of a line or on a backward jump, so it is followed along each probe closure;
+  where it still depends on the path taken to reach the probe, the ids for each possible line are marked.
+  Code is not probed (i.e. the plan is None) if it uses YIELD_FROM, which resumes at itself;
+  if a `break` or `continue` runs `finally` or `with` cleanup code, which the traced edges do not describe;
+  or if an exception handler is also entered by an END_FINALLY or return whose edge marks different ids.
+  Return a ProbePlan:
+  * insts: ProbeInsts in order.
+  * entry_sites: maps offsets to the site of the probe placed immediately before the instruction.
+  * targets: maps the offsets of jump and SETUP instructions to the label they target, if not ('body', argval).
+  * trampolines: (site, dst_off) pairs; trampoline k has label ('tramp', k).
+  * site_ids: the tuple of edge ids marked by each site.
+  * n: the number of edge ids; id n flags an unexpected edge, as for edge bitmaps.
+  '''
+  from dis import findlinestarts, get_instructions
+  req, opt = crawl_code_insts(path=code.co_filename, code=code, dbg_name=dbg)
+  req_ids = defaultdict(list)
+  line_ids = {}
+  for i, (edge, line) in enumerate(req_edge_lines(req)):
+    req_ids[edge].append(i)
+    line_ids[(edge, line)] = i
+  n = sum(len(ids) for ids in req_ids.values())
+  raise_ids = { edge[1] : tuple(ids) for edge, ids in req_ids.items() if edge[0] == OFF_RAISED }
+  opt_raise_dsts = { edge[1] for edge in opt if edge[0] == OFF_RAISED }
+
+  def edge_ids(src, dst, lines=None):
+    '''
+    The ids that the bits tracer sets for a traced edge, if its line is one of `lines` (or any line, if `lines` is None);
+    this mirrors the precedence in `code_edge_ids`.
+    '''
+    edge = (src, dst)
+    if lines is None:
+      if edge in req_ids: return tuple(req_ids[edge])
+      if dst in raise_ids: return raise_ids[dst]
+      if edge in opt or dst in opt_raise_dsts: return ()
+      return (n,)
+    ids = set()
+    for line in lines:
+      try: ids.add(line_ids[(edge, line)])
+      except KeyError:
+        if line in opt.get(edge, ()): ids.update(raise_ids.get(dst, ()))
+        elif dst in raise_ids: ids.update(raise_ids[dst])
+        elif dst not in opt_raise_dsts: ids.add(n)
+    return tuple(ids)
+
+  insts = []
+  blocks = []
+  ext_off = None
+  for inst in get_instructions(code):
+    if inst.opcode == EXTENDED_ARG:
+      if ext_off is None: ext_off = inst.offset
+      continue
+    off = inst.offset if ext_off is None else ext_off
+    ext_off = None
+    while blocks and blocks[-1][1] == off: blocks.pop() # see crawl_code_insts.
+    if inst.opcode in setup_opcodes: blocks.append((inst.opcode, inst.argval))
+    insts.append(ProbeInst(off=off, op=inst.opcode, arg=inst.arg, argval=inst.argval, stack=tuple(blocks)))
+
+  succs = defaultdict(list) # Maps offsets to the offsets of runtime successors.
+  arrivals = defaultdict(list) # Maps offsets to (src_off, kind) pairs; kind is 'pos', 'jump', 'unwind' or 'handler'.
+  handler_setups = defaultdict(list) # Maps exception handler offsets to the offsets of the SETUP instructions.
+  def add(src, dst, kind):
+    succs[src].append(dst)
+    arrivals[dst].append((src, kind))
+
+  arrivals[insts[0].off].append((OFF_BEGIN, 'pos'))
+  for inst, nxt in zip(insts, insts[1:] + [None]):
+    op = inst.op
+    if op == YIELD_FROM: return None
+    if op not in stop_opcodes and nxt: add(inst.off, nxt.off, 'pos')
+    if op in jump_opcodes:
+      if op == CONTINUE_LOOP and unwinds_through_cleanup(inst): return None
+      add(inst.off, inst.argval, 'jump')
+    elif op in setup_exc_opcodes:
+      if not handler_setups[inst.argval]: arrivals[inst.argval].append((OFF_RAISED, 'handler'))
+      handler_setups[inst.argval].append(inst.off)
+    elif op == BREAK_LOOP:
+      if unwinds_through_cleanup(inst): return None
+      add(inst.off, find_block_dst_off(inst, (SETUP_LOOP,)), 'unwind')
+    elif op == RETURN_VALUE:
+      dst_off = find_block_dst_off(inst, (SETUP_ASYNC_WITH, SETUP_FINALLY, SETUP_WITH))
+      if dst_off: add(inst.off, dst_off, 'unwind')
+    elif op == YIELD_VALUE and nxt:
+      arrivals[nxt.off].append((OFF_BEGIN, 'pos')) # resumption.
+
+  ops = { inst.off : inst.op for inst in insts }
+  def is_folded(off): return ops.get(off) in nonraising_opcodes and len(succs[off]) == 1
+
+  line_starts = dict(findlinestarts(code))
+  table_lines = {} # Maps offsets to the line of the line table range that contains each instruction.
+  line = code.co_firstlineno
+  for inst in insts:
+    line = line_starts.get(inst.off, line)
+    table_lines[inst.off] = line
+
+  def edge_lines(src, dst, src_lines):
+    '''
+    The possible values of `f_lineno` at the traced edge (src, dst), given those at `src`; None if unknown.
+    The interpreter updates the line at the first instruction of a frame, at the start of a line, and on a backward jump.
+    '''
+    if dst == 0 or dst in line_starts or 0 <= dst < src: return (table_lines[dst],)
+    return src_lines
+
+  lines_at = { inst.off : () for inst in insts } # The possible lines at each instruction; None if unknown.
+  is_changed = True
+  while is_changed: # the sets only grow, and None absorbs, so this reaches a fixpoint.
+    is_changed = False
+    for inst in insts:
+      lines = set()
+      for src, _ in arrivals[inst.off]:
+        src_lines = edge_lines(src, inst.off, lines_at[src] if src >= 0 else None)
+        if src_lines is None:
+          lines = None
+          break
+        lines.update(src_lines)
+      if lines is not None: lines = tuple(sorted(lines))
+      if lines != lines_at[inst.off]:
+        lines_at[inst.off] = lines
+        is_changed = True
+
+  # Entering a handler by an exception, an END_FINALLY, or a return that unwinds to it are indistinguishable.
+  for inst in insts:
+    if inst.op == END_FINALLY:
+      dst_offs = [dst for op, dst in inst.stack if op in setup_exc_opcodes]
+    elif inst.op == RETURN_VALUE:
+      dst_offs = succs[inst.off]
+    else: continue
+    for dst in dst_offs:
+      handler_ids = edge_ids(OFF_RAISED, dst)
+      if handler_ids and not set(handler_ids) <= set(edge_ids(inst.off, dst)): return None
+
+  entry_sites = {}
+  targets = {}
+  trampolines = []
+  site_ids = []
+  for inst in insts:
+    dst = inst.off
+    dst_arrivals = arrivals[dst]
+    for src, kind in dst_arrivals:
+      if is_folded(src): continue
+      ids = probe_closure(src, dst, (lines_at[src] if src >= 0 else None), edge_ids, edge_lines, succs, is_folded)
+      if not ids: continue
+      site = len(site_ids)
+      site_ids.append(ids)
+      srcs = handler_setups[dst] if kind == 'handler' else [src]
+      if kind == 'pos' or len(dst_arrivals) == 1:
+        entry_sites[dst] = site
+        label = ('entry', dst)
+      else:
+        label = ('tramp', len(trampolines))
+        trampolines.append((site, dst))
+      if kind != 'pos':
+        for s in srcs: targets[s] = label
+  return ProbePlan(insts=insts, entry_sites=entry_sites, targets=targets, trampolines=trampolines, site_ids=site_ids, n=n)
+
+
+def unwinds_through_cleanup(inst):
+  'True if the BREAK_LOOP or CONTINUE_LOOP `inst` runs `finally` or `with` cleanup code before reaching its loop.'
+  for op, _ in reversed(inst.stack):
+    if op == SETUP_LOOP: return False
+    if op in (SETUP_ASYNC_WITH, SETUP_FINALLY, SETUP_WITH): return True
+  return False
+
+
+def probe_closure(src, dst, src_lines, edge_ids, edge_lines, succs, is_folded):
+  '''
+  The sorted ids of the edge (src, dst), and of every edge that is then taken through folded instructions,
+  following the possible lines in effect from `src_lines`, those at `src`.
+  '''
+  lines = edge_lines(src, dst, src_lines)
+  ids = set(edge_ids(src, dst, lines))
+  visited = set()
+  while is_folded(dst) and dst not in visited: # an infinite loop of jumps is a cycle.
+    visited.add(dst)
+    src, dst = dst, succs[dst][0]
+    lines = edge_lines(src, dst, lines)
+    ids.update(edge_ids(src, dst, lines))
+  return tuple(sorted(ids))
+
+
+def assemble_probes(code, plan, consts, hits):
+  '''
+  Return a copy of `code` with the probes of `plan` inserted, and with `consts` (which contains any instrumented nested code)
+  followed by the probe constants: the value 1, the `hits` bytearray, and the index of each site.
+  Each probe is `hits[site] = 1`; the stack size grows by the three values that it pushes.
+  Jump arguments and EXTENDED_ARG prefixes are computed for the new layout, and the line number table is rebuilt:
+  a probe before an instruction belongs to its line, and a trampoline to the line of its destination.
+  '''
+  from dis import findlinestarts
+  consts = list(consts)
+  one_index = len(consts)
+  consts.extend([1, hits])
+  site_indices = range(len(consts), len(consts) + len(plan.site_ids))
+  consts.extend(range(len(plan.site_ids)))
+
+  insts = [] # (opcode, arg, target label) triples; the arg of a jump is computed from its target.
+  labels = {} # Maps labels to the index of the instruction that they precede.
+  line_labels = [] # (label, line) pairs, in order.
+  def probe(site):
+    insts.extend([(LOAD_CONST, one_index, None), (LOAD_CONST, one_index + 1, None),
+      (LOAD_CONST, site_indices[site], None), (STORE_SUBSCR, 0, None)])
+
+  line_starts = dict(findlinestarts(code))
+  inst_lines = {} # Maps offsets to the line in effect at each instruction.
+  line = code.co_firstlineno
+  for inst in plan.insts:
+    labels[('entry', inst.off)] = len(insts)
+    if inst.off in line_starts:
+      line = line_starts[inst.off]
+      line_labels.append((('entry', inst.off), line))
+    inst_lines[inst.off] = line
+    if inst.off in plan.entry_sites: probe(plan.entry_sites[inst.off])
+    labels[('body', inst.off)] = len(insts)
+    if inst.op in hasjabs or inst.op in hasjrel:
+      insts.append((inst.op, 0, plan.targets.get(inst.off, ('body', inst.argval))))
+    else:
+      insts.append((inst.op, inst.arg or 0, None))
+  for k, (site, dst) in enumerate(plan.trampolines):
+    labels[('tramp', k)] = len(insts)
+    line_labels.append((('tramp', k), inst_lines[dst]))
+    probe(site)
+    insts.append((JUMP_ABSOLUTE, 0, ('body', dst)))
+
+  # Inserting EXTENDED_ARG prefixes moves the jump targets, which can require further prefixes; iterate until stable.
+  sizes = [2] * len(insts)
+  while True:
+    offs = [0]
+    for size in sizes: offs.append(offs[-1] + size)
+    args = []
+    for i, (op, arg, target) in enumerate(insts):
+      if target is not None:
+        dst = offs[labels[target]]
+        arg = dst if op in hasjabs else dst - offs[i + 1]
+      args.append(arg)
+    new_sizes = [max(size, 2 * (1 + (arg > 0xff) + (arg > 0xffff) + (arg > 0xffffff))) for size, arg in zip(sizes, args)]
+    if new_sizes == sizes: break
+    sizes = new_sizes
+
+  co_code = bytearray()
+  for (op, _, _), arg, size in zip(insts, args, sizes):
+    for shift in range(8 * (size // 2 - 1), 0, -8):
+      co_code.extend((EXTENDED_ARG, (arg >> shift) & 0xff))
+    co_code.extend((op, arg & 0xff))
+  lnotab = encode_lnotab(code.co_firstlineno, [(offs[labels[label]], line) for label, line in line_labels])
+  return replace_code(code, co_code=bytes(co_code), co_consts=tuple(consts), co_lnotab=lnotab,
+    co_stacksize=code.co_stacksize + 3)
+
+
+def encode_lnotab(first_line, line_starts):
+  'Encode (offset, line) pairs, in offset order, as a line number table; line increments are signed bytes.'
+  lnotab = bytearray()
+  prev_off = 0
+  prev_line = first_line
+  for off, line in line_starts:
+    d_off = off - prev_off
+    d_line = line - prev_line
+    if not (d_off or d_line): continue
+    while d_off > 0xff:
+      lnotab.extend((0xff, 0))
+      d_off -= 0xff
+    while d_line > 0x7f:
+      lnotab.extend((d_off, 0x7f))
+      d_off = 0
+      d_line -= 0x7f
+    while d_line < -0x80:
+      lnotab.extend((d_off, 0x80))
+      d_off = 0
+      d_line += 0x80
+    lnotab.extend((d_off, d_line & 0xff))
+    prev_off = off
+    prev_line = line
+  return bytes(lnotab)
+
+
+def replace_code(code, **changes):
+  'Return a copy of `code` with the given attributes replaced; `CodeType.replace` is only available in Python 3.8+.'
+  try: replace = code.replace
+  except AttributeError: pass
+  else: return replace(**changes)
+  return CodeType(*(changes.get(attr, getattr(code, attr)) for attr in ('co_argcount', 'co_kwonlyargcount',
+    'co_nlocals', 'co_stacksize', 'co_flags', 'co_code', 'co_consts', 'co_names', 'co_varnames', 'co_filename',
+    'co_name', 'co_firstlineno', 'co_lnotab', 'co_freevars', 'co_cellvars')))
+
+
+def merge_edges(code_edges, key, edges, codes=None):
+  '''
+  Merge traced `edges` into the `code_edges` dictionary under `key`,
+  which is either a code object, or a `code_key` for which `codes` holds the interned code object.
+  Sets are unioned and bitmaps are or'd; if a code was traced in both modes, the bitmap is converted to a set.
+  '''
+  try: existing = code_edges[key]
+  except KeyError:
+    code_edges[key] = bytearray(edges) if is_edge_bits(edges) else set(edges)
+    return
+  if not is_edge_bits(existing) and not is_edge_bits(edges):
+    existing.update(edges)
+    return
+  if is_edge_bits(existing) and is_edge_bits(edges):
+    assert len(existing) == len(edges)
+    # Every byte is 0 or 1, so or'ing the bitmaps as integers is equivalent to or'ing them bytewise.
+    existing[:] = (int.from_bytes(existing, 'little') | int.from_bytes(edges, 'little')).to_bytes(len(edges), 'little')
+    return
+  code = key if codes is None else codes[key]
+  req, _ = crawl_code_insts(path=code.co_filename, code=code, dbg_name=None)
+  if is_edge_bits(existing):
+    existing = code_edges[key] = edges_from_bits(existing, req)
+  else:
+    edges = edges_from_bits(edges, req) if is_edge_bits(edges) else edges
+  existing.update(edges)
+
+
+def code_key(code):
+  '''
+  A stable, compact identity for a code object within a source path: (co_name, co_firstlineno, digest).
+  The path itself is implied by the context in which keys are used, i.e. trace sections and merged data are per path.
+  Keys are cheap to hash and compare, unlike code objects, whose equality walks co_consts recursively.
+  '''
+  return (code.co_name, code.co_firstlineno, code_digest(code))
+
+
+def code_digest(code):
+  '''
+  A digest of the attributes that determine code object equality, plus the line table, but excluding co_filename,
+  so that the same script traced via different relative paths still merges.
+  Nested code objects contribute their own digests, and frozenset constants are sorted,
+  so that the digest does not depend on string hash randomization.
+  Values are encoded with marshal version 0, which has no object references or interning flags;
+  later versions mark objects by their reference counts and interning,
+  which differ for the same code depending on how it was loaded.
+  '''
+  from hashlib import blake2b
+  h = blake2b(marshal.dumps((code.co_argcount, code.co_kwonlyargcount, code.co_nlocals, code.co_flags,
+    code.co_code, code.co_names, code.co_varnames, code.co_freevars, code.co_cellvars, code.co_name,
+    code.co_firstlineno, code.co_lnotab), 0), digest_size=16)
+  for const in code.co_consts:
+    h.update(const_digest_bytes(const))
+  return h.digest()
+
+
+def const_digest_bytes(const):
+  if isinstance(const, CodeType): return b'c' + code_digest(const)
+  if isinstance(const, tuple): return b't(' + b','.join(const_digest_bytes(c) for c in const) + b')'
+  if isinstance(const, frozenset): return b'f(' + b','.join(sorted(const_digest_bytes(c) for c in const)) + b')'
+  return marshal.dumps(const, 0)
 
 
 def fixup_traceback(traceback):
@@ -205,62 +1902,732 @@ def fixup_traceback(traceback):
   #^ TODO: verify that the above is sufficiently strict,
   #^ while also covering both the installed entry_point and the local dev cases.
   del stack[0]
+  if stack and stack[0].name == 'run_main': del stack[0]
   while stack and stack[0].filename.endswith('runpy.py'): del stack[0] # remove coven runpy.run_path frames.
 
 
-def write_coverage(output_path, target_paths, path_code_edges):
+def write_coverage(output_path, target_paths, path_code_edges, sample_rate=1.0, format='indexed', compression='zlib'):
+  if format == 'indexed':
+    write_indexed_trace(output_path, target_paths, path_code_edges, sample_rate=sample_rate, compression=compression)
+    return
   data = {
     'target_paths': target_paths,
     'path_code_edges': path_code_edges,
+    'sample_rate': sample_rate, # less than 1 for sampled traces.
   }
   with open(output_path, 'wb') as f:
     marshal.dump(data, f)
 
 
-def coalesce(trace_paths, arg_targets, args):
-  target_path_sets = defaultdict(set)
-  for t in arg_targets:
-    target_path_sets[t] = set()
-  path_code_edges = defaultdict(lambda: defaultdict(set))
-  for trace_path in trace_paths:
+# Indexed trace format:
+# * TRACE_MAGIC;
+# * the header length, as a little-endian u64;
+# * the header, a marshaled dict: version, compression, target_paths, sample_rate, and 'sections',
+#   which maps each path to a tuple of the (offset, length) pair of its edges section, relative to the end of the header;
+# * the sections, each (possibly compressed) marshaled data:
+#   a list of (key, kind, data) triples; see `code_key` and `encode_edges`.
+# A reader can therefore memory map the file and decode only the sections for the paths it needs.
+# Code objects are not stored: a reader compiles the source of a path to resolve its keys (see `source_codes`),
+# once per path rather than once per trace.
+# Version 1 stored (code, kind, data) triples in a single section per path,
+# and version 2 followed the edges section of each path with a section of (key, code) pairs; both remain readable.
+TRACE_MAGIC = b'coven-trace\n'
+TRACE_FORMAT_VERSION = 3
+
+
+def write_indexed_trace(output_path, target_paths, path_code_edges, sample_rate, compression):
+  from struct import pack
+  compress = trace_compressor(compression)
+  sections = {}
+  chunks = []
+  offset = 0
+  for path, code_edges in sorted(path_code_edges.items()):
+    chunk = marshal.dumps([(code_key(code), *encode_edges(edges)) for code, edges in code_edges.items()])
+    if compress: chunk = compress(chunk)
+    sections[path] = ((offset, len(chunk)),)
+    chunks.append(chunk)
+    offset += len(chunk)
+  header = marshal.dumps({
+    'version': TRACE_FORMAT_VERSION,
+    'compression': compression if compress else None,
+    'target_paths': target_paths,
+    'sample_rate': sample_rate,
+    'sections': sections,
+  })
+  with open(output_path, 'wb') as f:
+    f.write(TRACE_MAGIC)
+    f.write(pack('<Q', len(header)))
+    f.write(header)
+    for chunk in chunks: f.write(chunk)
+
+
+def trace_compressor(compression):
+  if compression == 'zlib':
+    from zlib import compress
+    return compress
+  if compression == 'lzma':
+    from lzma import compress
+    return compress
+  return None
+
+
+def trace_decompressor(compression):
+  if compression == 'zlib':
+    from zlib import decompress
+    return decompress
+  if compression == 'lzma':
+    from lzma import decompress
+    return decompress
+  if compression is None: return None
+  exit(f'coven error: unsupported trace compression: {compression!r}')
+
+
+def encode_edges(edges):
+  '''
+  Encode the recorded edges of a code object as a (kind, data) pair for an indexed trace:
+  bitmaps are stored as is; edge sets are stored as a flat array of sorted little-endian int32 triples,
+  and line sets as an array of sorted little-endian int32 lines.
+  '''
+  if is_edge_bits(edges): return ('bits', bytes(edges))
+  if is_line_set(edges):
+    a = array('i', sorted(edges))
+    if sys.byteorder == 'big': a.byteswap()
+    return ('lines', a.tobytes())
+  a = array('i', chain.from_iterable(sorted(edges)))
+  if sys.byteorder == 'big': a.byteswap()
+  return ('sets', a.tobytes())
+
+
+def decode_edges(kind, data):
+  if kind == 'bits': return data
+  a = array('i')
+  a.frombytes(data)
+  if sys.byteorder == 'big': a.byteswap()
+  if kind == 'lines': return set(a)
+  return set(zip(a[0::3], a[1::3], a[2::3]))
+
+
+class TraceReader:
+  '''
+  Read a trace file in either the indexed or the legacy marshal format.
+  Indexed traces are memory mapped: only the header is parsed up front,
+  and the sections for a path are only read and decoded when `key_edges` or `codes` is called for it.
+  Legacy traces are loaded in full, and keyed by code object; keys for them are computed on demand.
+  '''
+
+  def __init__(self, trace_path):
+    self.mmap = None
     try: f = open(trace_path, 'rb')
     except FileNotFoundError:
       exit(f'coven error: trace file not found: {trace_path}')
-    with f: data = marshal.load(f)
-    for target, path in data['target_paths'].items():
-      if arg_targets and target not in arg_targets: continue
-      s = target_path_sets[target] # materialize the set; leave empty for None case.
-      if path is not None: s.add(path)
-    target_path_lists = { t : sorted(paths) for t, paths in target_path_sets.items() }
-    for path, code_edges in data['path_code_edges'].items():
-      for code, edges in code_edges.items():
-        path_code_edges[path][code].update(edges)
-  report(target_path_lists=target_path_lists, path_code_edges=path_code_edges, args=args)
-
-
-def report(target_path_lists, path_code_edges, args):
+    with f:
+      if f.read(len(TRACE_MAGIC)) != TRACE_MAGIC:
+        f.seek(0)
+        data = marshal.load(f)
+        self.target_paths = data['target_paths']
+        self.sample_rate = data.get('sample_rate', 1.0)
+        self.legacy_path_code_edges = data['path_code_edges']
+        self.paths = list(self.legacy_path_code_edges)
+        return
+      from mmap import mmap, ACCESS_READ
+      self.mmap = mmap(f.fileno(), 0, access=ACCESS_READ)
+    from struct import unpack_from
+    pos = len(TRACE_MAGIC)
+    header_len, = unpack_from('<Q', self.mmap, pos)
+    pos += 8
+    header = marshal.loads(self.mmap[pos:pos+header_len])
+    self.version = header['version']
+    if self.version not in (1, 2, TRACE_FORMAT_VERSION):
+      exit(f'coven error: unsupported trace format version: {self.version}: {trace_path}')
+    self.sections_start = pos + header_len
+    self.sections = header['sections']
+    self.decompress = trace_decompressor(header['compression'])
+    self.target_paths = header['target_paths']
+    self.sample_rate = header['sample_rate']
+    self.paths = list(self.sections)
+
+  def __enter__(self): return self
+
+  def __exit__(self, *exc_info): self.close()
+
+  def close(self):
+    if self.mmap is not None:
+      self.mmap.close()
+      self.mmap = None
+
+  def read_section(self, offset, length):
+    start = self.sections_start + offset
+    chunk = self.mmap[start:start+length]
+    if self.decompress: chunk = self.decompress(chunk)
+    return marshal.loads(chunk)
+
+  def is_keyed_by_code(self):
+    return self.mmap is None or self.version == 1
+
+  def code_edges_by_code(self, path):
+    'For legacy and version 1 traces only.'
+    if self.mmap is None: return self.legacy_path_code_edges[path]
+    return { code : decode_edges(kind, data) for code, kind, data in self.read_section(*self.sections[path]) }
+
+  def key_edges(self, path):
+    'Return a dictionary mapping the `code_key` of each traced code object in `path` to its edges.'
+    if self.is_keyed_by_code():
+      return { code_key(code) : edges for code, edges in self.code_edges_by_code(path).items() }
+    edges_location = self.sections[path][0]
+    return { key : decode_edges(kind, data) for key, kind, data in self.read_section(*edges_location) }
+
+  def codes(self, path):
+    '''
+    Return a dictionary mapping the `code_key` of each code object in `path` to the code object:
+    the traced code objects for traces that store them, or else those compiled from the current source of `path`.
+    '''
+    if self.is_keyed_by_code():
+      return { code_key(code) : code for code in self.code_edges_by_code(path) }
+    if self.version == 2:
+      _, codes_location = self.sections[path]
+      return dict(self.read_section(*codes_location))
+    return source_codes(path)
+
+
+def source_codes(path):
+  '''
+  Compile the source of `path` as the import system does, and return a dictionary mapping the `code_key`
+  of the module code and each nested code object to that code object.
+  Keys digest the bytecode, so code that was traced from a different version of the source does not match.
+  '''
+  try: f = open(path, 'rb')
+  except FileNotFoundError: exit(f'coven error: source file not found: {path}')
+  with f: source = f.read()
+  module_code = compile(source, path, 'exec', dont_inherit=True)
+  return { code_key(code) : code for code in visit_nodes(start_nodes=[module_code], visitor=sub_codes) }
+
+
+def merge_trace_path(reader, path, key_edges, codes):
+  '''
+  Merge the edges for `path` from `reader` into the `key_edges` dictionary,
+  interning a single code object per key in `codes`; code objects are only read or compiled if there are new keys.
+  Return the merged edges of `reader`, without those of keys that match no code object (see `intern_trace_codes`).
+  '''
+  new_key_edges = intern_trace_codes(reader, path, reader.key_edges(path), codes)
+  for key, edges in new_key_edges.items():
+    merge_edges(key_edges, key, edges, codes)
+  return new_key_edges
+
+
+def intern_trace_codes(reader, path, key_edges, codes):
+  '''
+  Add the code objects of `path` from `reader` to `codes` if `key_edges` has any key that is not already interned.
+  Return `key_edges` without the keys that still match no code object, which can only happen for traces that
+  do not store code objects, when the source has changed since it was traced; these are dropped with a warning.
+  '''
+  if all(key in codes for key in key_edges): return key_edges
+  for key, code in reader.codes(path).items():
+    codes.setdefault(key, code)
+  stale = [key for key in key_edges if key not in codes]
+  if not stale: return key_edges
+  for line, name in sorted((line, name) for name, line, _ in stale):
+    errSL(f'coven WARNING: {path}:{line}: {name}: traced code does not match the current source; ignoring its edges.')
+  return { key : edges for key, edges in key_edges.items() if key in codes }
+
+
+def code_edges_for_keys(key_edges, codes):
+  '''
+  Convert merged, key-indexed edges back to the code-indexed form that `calculate_coverage` expects.
+  Distinct keys can intern equal code objects, because code equality ignores the line table, which keys include;
+  the edges of such keys are merged.
+  '''
+  code_edges = {}
+  for key, edges in key_edges.items():
+    code = codes[key]
+    existing = code_edges.get(code)
+    if existing is None:
+      code_edges[code] = edges
+      continue
+    # Copy the existing edges before merging into them, because they may be immutable or belong to `key_edges`.
+    code_edges[code] = bytearray(existing) if is_edge_bits(existing) else set(existing)
+    merge_edges(code_edges, code, edges)
+  return code_edges
+
+
+# Trace index.
+# A persistent reverse index from each (path, line) to the trace files that traced it,
+# used to select the traces (i.e. tests) that exercised a set of changed lines.
+trace_index_schema = '''
+CREATE TABLE IF NOT EXISTS trace (id INTEGER PRIMARY KEY, path TEXT NOT NULL UNIQUE,
+  size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS file (id INTEGER PRIMARY KEY, path TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS line (file_id INTEGER NOT NULL, line INTEGER NOT NULL, trace_id INTEGER NOT NULL,
+  PRIMARY KEY (file_id, line, trace_id)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS line_trace ON line (trace_id);
+'''
+
+
+def update_trace_index(db_path, trace_paths, cache=None, progress=False):
+  '''
+  Add the traced lines of each trace file to the index at `db_path`, creating it if necessary.
+  The index is incremental: traces whose size and modification time are unchanged since they were indexed are skipped,
+  changed traces are reindexed, and indexed traces that no longer exist are dropped.
+  '''
+  import sqlite3
+  db = sqlite3.connect(db_path)
+  indexed = unchanged = 0
+  try:
+    with db:
+      db.executescript(trace_index_schema)
+      file_id = db_file_ids(db)
+      path_codes = {} # Maps paths to interned code objects, keyed by `code_key`, across all traces.
+      for trace_path in trace_paths:
+        trace_path = abs_path(trace_path)
+        try: st = os.stat(trace_path)
+        except FileNotFoundError: exit(f'coven error: trace file not found: {trace_path}')
+        row = db.execute('SELECT id, size, mtime_ns FROM trace WHERE path = ?', (trace_path,)).fetchone()
+        if row and row[1:] == (st.st_size, st.st_mtime_ns):
+          unchanged += 1
+          continue
+        if row:
+          db.execute('DELETE FROM line WHERE trace_id = ?', (row[0],))
+          db.execute('DELETE FROM trace WHERE id = ?', (row[0],))
+        trace_id = db.execute('INSERT INTO trace (path, size, mtime_ns) VALUES (?, ?, ?)',
+          (trace_path, st.st_size, st.st_mtime_ns)).lastrowid
+        with TraceReader(trace_path) as reader:
+          for path in reader.paths:
+            codes = path_codes.setdefault(path, {})
+            lines = set()
+            for key, edges in intern_trace_codes(reader, path, reader.key_edges(path), codes).items():
+              lines.update(traced_lines(codes[key], edges, cache=cache))
+            fid = file_id(path)
+            db.executemany('INSERT OR IGNORE INTO line VALUES (?, ?, ?)', ((fid, line, trace_id) for line in lines))
+        indexed += 1
+        if progress: errSL(f'coven index: indexed {trace_path}.')
+      removed = 0
+      for trace_id, trace_path in db.execute('SELECT id, path FROM trace').fetchall():
+        if os.path.exists(trace_path): continue
+        db.execute('DELETE FROM line WHERE trace_id = ?', (trace_id,))
+        db.execute('DELETE FROM trace WHERE id = ?', (trace_id,))
+        removed += 1
+  finally:
+    db.close()
+  errSL(f'coven index: {db_path}: {indexed} indexed; {unchanged} unchanged; {removed} removed.')
+
+
+def select_indexed_traces(db_path, changes):
+  '''
+  Return the sorted paths of the indexed traces that traced any of the `changes`,
+  a dictionary mapping absolute paths to sets of changed lines, or to None if any line of the path counts.
+  '''
+  import sqlite3
+  if not os.path.isfile(db_path): exit(f'coven error: trace index not found: {db_path}')
+  db = sqlite3.connect(db_path)
+  try:
+    db.execute('CREATE TEMP TABLE changed (file_id INTEGER NOT NULL, line INTEGER)')
+    for path, lines in changes.items():
+      row = db.execute('SELECT id FROM file WHERE path = ?', (path,)).fetchone()
+      if row is None: continue # never traced.
+      if lines is None: db.execute('INSERT INTO changed VALUES (?, NULL)', row)
+      else: db.executemany('INSERT INTO changed VALUES (?, ?)', ((row[0], line) for line in lines))
+    rows = db.execute('SELECT DISTINCT trace.path FROM changed JOIN line ON line.file_id = changed.file_id '
+      'AND (changed.line IS NULL OR line.line = changed.line) JOIN trace ON trace.id = line.trace_id '
+      'ORDER BY trace.path').fetchall()
+  except sqlite3.DatabaseError as e: exit(f'coven error: could not query trace index: {db_path}: {e}')
+  finally: db.close()
+  return [path for path, in rows]
+
+
+def parse_changes(specs):
+  '''
+  Parse change specifications of the form PATH, PATH:LINE or PATH:START-END into the `changes` dictionary
+  for `select_indexed_traces`; a bare PATH means that any line of it counts.
+  '''
+  import re
+  change_spec_re = re.compile(change_spec_pattern)
+  changes = {}
+  for spec in specs:
+    m = change_spec_re.fullmatch(spec)
+    path = abs_path(m['path'] if m else spec)
+    if not m:
+      changes[path] = None
+      continue
+    start = int(m['start'])
+    lines = range(start, int(m['end'] or start) + 1)
+    existing = changes.setdefault(path, set())
+    if existing is not None: existing.update(lines)
+  return changes
+
+change_spec_pattern = r'(?P<path>.+):(?P<start>\d+)(?:-(?P<end>\d+))?'
+
+
+def git_changed_lines(base):
+  '''
+  Return the `changes` dictionary for `select_indexed_traces` for the differences between the git revision `base`
+  and the working tree. Lines are numbered as in `base`, against which the existing traces were presumably recorded;
+  a pure insertion counts as a change to the lines on either side of it.
+  '''
+  import re
+  from subprocess import PIPE, run
+  diff_hunk_re = re.compile(diff_hunk_pattern)
+  def git(*cmd):
+    try: r = run(['git', *cmd], stdout=PIPE, stderr=PIPE, universal_newlines=True)
+    except FileNotFoundError: exit('coven error: git not found.')
+    if r.returncode: exit(f'coven error: git {cmd[0]} failed: {r.stderr.strip()}')
+    return r.stdout
+  root = git('rev-parse', '--show-toplevel').strip()
+  changes = defaultdict(set)
+  path = None
+  for line in git('diff', '-U0', '--no-color', '--no-ext-diff', '--src-prefix=a/', '--dst-prefix=b/', base).splitlines():
+    if line.startswith('--- '):
+      src = line[4:]
+      path = None if src == '/dev/null' else abs_path(path_join(root, src[2:])) # a new file has never been traced.
+    elif line.startswith('@@ ') and path:
+      m = diff_hunk_re.match(line)
+      start = int(m['start'])
+      count = 1 if m['count'] is None else int(m['count'])
+      changes[path].update(range(start, start + count) if count else (start, start + 1))
+  return changes
+
+diff_hunk_pattern = r'@@ -(?P<start>\d+)(?:,(?P<count>\d+))? '
+
+
+def coalesce(trace_paths, arg_targets, args, profile=None):
+  'Load and merge the traces, and report them; return the total stats.'
+  if args.stream_mem:
+    return coalesce_streaming(trace_paths, arg_targets, args, profile=profile)
+  start_time = perf_counter()
+  with profile_phase(profile, 'load'):
+    wanted_paths = None
+    if arg_targets:
+      # Only sections for the paths of the requested targets need to be read.
+      target_path_sets, _, _ = scan_traces(trace_paths, arg_targets)
+      wanted_paths = set().union(*target_path_sets.values())
+    if args.jobs > 1 and len(trace_paths) > 1 and total_file_size(trace_paths) >= parallel_load_min_size:
+      target_path_sets, path_key_edges, path_codes, sampled = load_traces_parallel(trace_paths, arg_targets,
+        wanted_paths, args)
+    else:
+      target_path_sets, path_key_edges, path_codes, sampled = load_traces(trace_paths, arg_targets, wanted_paths,
+        progress=args.progress)
+    path_code_edges = { path : code_edges_for_keys(key_edges, path_codes[path])
+      for path, key_edges in path_key_edges.items() }
+  load_time = perf_counter()
+  if args.progress: errSL(f'coven coalesce: loaded and merged {len(trace_paths)} traces: {load_time - start_time:.3f}s.')
+  target_path_lists = { t : sorted(paths) for t, paths in target_path_sets.items() }
+  with profile_phase(profile, 'report'):
+    totals = report(target_path_lists=target_path_lists, path_code_edges=defaultdict(dict, path_code_edges), args=args,
+      sampled=sampled, profile=profile)
+  if args.progress: errSL(f'coven coalesce: reported {len(path_code_edges)} paths: {perf_counter() - load_time:.3f}s.')
+  return totals
+
+
+def load_traces(trace_paths, arg_targets, wanted_paths=None, progress=False):
+  '''
+  Load and merge trace files, returning (target_path_sets, path_key_edges, path_codes, sampled):
+  * path_key_edges maps paths to dictionaries of merged edges, keyed by `code_key`;
+  * path_codes maps paths to dictionaries of interned code objects, keyed by `code_key`;
+  * sampled is the number of sampled traces.
+  If `wanted_paths` is not None, only the edges for those paths are loaded.
+  '''
+  target_path_sets = defaultdict(set)
+  for t in arg_targets:
+    target_path_sets[t] = set()
+  path_key_edges = defaultdict(dict)
+  path_codes = defaultdict(dict)
+  sampled = 0
+  for i, trace_path in enumerate(trace_paths, 1):
+    with TraceReader(trace_path) as reader:
+      if reader.sample_rate < 1: sampled += 1
+      add_target_paths(target_path_sets, reader.target_paths, arg_targets)
+      for path in reader.paths:
+        if wanted_paths is not None and path not in wanted_paths: continue
+        merge_trace_path(reader, path, path_key_edges[path], path_codes[path])
+    if progress and (i % 100 == 0 or i == len(trace_paths)):
+      errSL(f'coven coalesce: loaded {i}/{len(trace_paths)} traces.')
+  return dict(target_path_sets), dict(path_key_edges), dict(path_codes), sampled
+
+
+def add_target_paths(target_path_sets, target_paths, arg_targets):
+  'Target path values are a path, None, or (for traces that were coalesced from subprocesses) a list of paths.'
+  for target, path in target_paths.items():
+    if arg_targets and target not in arg_targets: continue
+    s = target_path_sets[target] # materialize the set; leave empty for None case.
+    if isinstance(path, list): s.update(path)
+    elif path is not None: s.add(path)
+
+
+def scan_traces(trace_paths, arg_targets):
+  '''
+  Read just the headers of trace files (legacy traces must be loaded in full),
+  returning (target_path_sets, last_trace_indices, sampled),
+  where `last_trace_indices` maps each path to the index of the last trace that contains edges for it.
+  '''
+  target_path_sets = defaultdict(set)
+  for t in arg_targets:
+    target_path_sets[t] = set()
+  last_trace_indices = {}
+  sampled = 0
+  for i, trace_path in enumerate(trace_paths):
+    with TraceReader(trace_path) as reader:
+      if reader.sample_rate < 1: sampled += 1
+      add_target_paths(target_path_sets, reader.target_paths, arg_targets)
+      for path in reader.paths:
+        last_trace_indices[path] = i
+  return target_path_sets, last_trace_indices, sampled
+
+
+def merge_loaded_traces(parts):
+  'Merge the results of `load_traces` in `parts`, in order, into a new result; parts may contain immutable bytes bitmaps.'
+  target_path_sets = defaultdict(set)
+  path_key_edges = defaultdict(dict)
+  path_codes = defaultdict(dict)
+  sampled = 0
+  for t_p_s, p_k_e, p_c, s in parts:
+    sampled += s
+    for target, paths in t_p_s.items():
+      target_path_sets[target].update(paths)
+    for path, codes in p_c.items():
+      interned = path_codes[path]
+      for key, code in codes.items():
+        interned.setdefault(key, code)
+    for path, key_edges in p_k_e.items():
+      for key, edges in key_edges.items():
+        merge_edges(path_key_edges[path], key, edges, path_codes[path])
+  return dict(target_path_sets), dict(path_key_edges), dict(path_codes), sampled
+
+
+# Below this total size of trace files, starting a process pool and marshaling the partial results
+# costs more than loading the traces in parallel saves, so `coalesce` loads them serially.
+# Each worker pays a fixed cost (e.g. compiling the sources of its paths; see `source_codes`),
+# and the pool adds about 0.25 s over a serial load, whereas a serial load takes about 0.13 s per MB of traces.
+parallel_load_min_size = 4 << 20
+
+
+def total_file_size(paths):
+  'The total size of the files at `paths`, ignoring missing files, which are reported when they are read.'
+  size = 0
+  for path in paths:
+    try: size += os.stat(path).st_size
+    except FileNotFoundError: pass
+  return size
+
+
+def load_traces_parallel(trace_paths, arg_targets, wanted_paths, args):
+  '''
+  Load trace files across a process pool: each worker loads and merges one contiguous chunk of the traces,
+  so that each partial result is marshaled only once, and the parent merges the partial results in trace order,
+  as each arrives, so the result does not depend on timing.
+  Partial results cross process boundaries in marshal format, because code objects cannot be pickled.
+  '''
+  from concurrent.futures import ProcessPoolExecutor
+  n = len(trace_paths)
+  chunk_size = -(-n // args.jobs) # ceiling division.
+  chunks = [trace_paths[i:i+chunk_size] for i in range(0, n, chunk_size)]
+  with ProcessPoolExecutor(max_workers=len(chunks)) as executor:
+    start_time = perf_counter()
+
+    def parts():
+      for i, part in enumerate(executor.map(load_traces_job, ((chunk, arg_targets, wanted_paths) for chunk in chunks))):
+        yield marshal.loads(part)
+        if args.progress:
+          errSL(f'coven coalesce: merged {min(n, (i + 1) * chunk_size)}/{n} traces: {perf_counter() - start_time:.3f}s.')
+
+    return merge_loaded_traces(parts())
+
+
+def load_traces_job(job):
+  'Process pool entry point for `load_traces_parallel`.'
+  trace_paths, arg_targets, wanted_paths = job
+  return marshal.dumps(load_traces(trace_paths, arg_targets, wanted_paths))
+
+
+def coalesce_streaming(trace_paths, arg_targets, args, profile=None):
+  '''
+  Coalesce with bounded memory.
+  A first pass reads the target paths of each trace, and notes the last trace that contains edges for each path.
+  The second pass merges edges path by path; once the last trace for a path has been merged,
+  that path is analyzed immediately and only its report text is retained.
+  Whenever the estimated size of the edges held in memory exceeds the `-stream-mem` ceiling,
+  the largest partial merges are appended to per-path spill files, which are read back when the path is final.
+  Output is identical to the regular coalesce, and each path is printed as soon as it and all preceding paths are final.
+  '''
+  with profile_phase(profile, 'scan'):
+    target_path_sets, last_trace_indices, sampled = scan_traces(trace_paths, arg_targets)
+  if args.progress: errSL(f'coven coalesce: scanned {len(trace_paths)} traces.')
+  target_path_lists = { t : sorted(paths) for t, paths in target_path_sets.items() }
+  results = stream_path_results(trace_paths, target_path_lists, last_trace_indices, args, profile=profile)
+  with profile_phase(profile, 'merge and report'):
+    return report(target_path_lists=target_path_lists, path_code_edges={}, args=args, sampled=sampled, results=results,
+      profile=profile)
+
+
+def stream_path_results(trace_paths, target_path_lists, last_trace_indices, args, profile=None):
+  '''
+  Yield (text, stats, export, cache_misses, None) for each reported path in report order; see `coalesce_streaming`.
+  Analysis times are recorded directly in `profile`, so the breakdown element is always None.
+  '''
+  from tempfile import TemporaryDirectory
+  max_size = int(args.stream_mem * 1000000)
+  cache = crawl_cache_for_args(args)
+  order = [(target, path) for target, paths in sorted(target_path_lists.items()) for path in paths]
+  path_targets = defaultdict(list)
+  for target, path in order:
+    path_targets[path].append(target)
+  merging = {} # Maps paths to partially merged edges, keyed by `code_key`.
+  path_codes = defaultdict(dict) # Maps paths to interned code objects; these are never spilled.
+  sizes = {} # Maps paths to the estimated size of their partially merged code edges.
+  spill_paths = {} # Maps paths to spill files.
+  results = {} # Maps (target, path) to (text, stats, export, cache_misses, None).
+  traces = enumerate(trace_paths)
+
+  with TemporaryDirectory(prefix='coven-stream-') as spill_dir:
+
+    def finalize(path):
+      key_edges = merging.pop(path, {})
+      codes = path_codes.pop(path, {})
+      sizes.pop(path, None)
+      spill_path = spill_paths.pop(path, None)
+      if spill_path:
+        with open(spill_path, 'rb') as f:
+          while True:
+            try: spilled = marshal.load(f)
+            except EOFError: break
+            for key, edges in spilled.items():
+              merge_edges(key_edges, key, edges, codes)
+        os.remove(spill_path)
+      code_edges = code_edges_for_keys(key_edges, codes)
+      del key_edges
+      misses = cache.misses if cache else 0
+      coverage = calculate_coverage(path=path, code_edges=code_edges, dbg=args.dbg, cache=cache, profile=profile,
+        lines=args.lines)
+      del code_edges
+      for target in path_targets[path]:
+        text, stats, export = report_path_captured(target=target, path=path, coverage=coverage, args=args,
+          profile=profile)
+        results[(target, path)] = (text, stats, export, (cache.misses - misses) if cache else 0, None)
+        misses = cache.misses if cache else 0
+
+    def spill():
+      total = sum(sizes.values())
+      for path in sorted(sizes, key=sizes.get, reverse=True):
+        if total <= max_size // 2: break
+        try: spill_path = spill_paths[path]
+        except KeyError: spill_path = spill_paths[path] = path_join(spill_dir, f'{len(spill_paths)}.marshal')
+        with open(spill_path, 'ab') as f: marshal.dump(merging.pop(path), f)
+        total -= sizes.pop(path)
+        if args.progress: errSL(f'coven coalesce: spilled: {path}')
+
+    for key in order:
+      path = key[1]
+      if path not in last_trace_indices: finalize(path) # no trace has edges for this path.
+      while key not in results:
+        i, trace_path = next(traces) # cannot be exhausted, because last_trace_indices refers to one of the traces.
+        final_paths = []
+        with TraceReader(trace_path) as reader:
+          for p in reader.paths:
+            if p not in path_targets: continue # not reported.
+            key_edges = merge_trace_path(reader, p, merging.setdefault(p, {}), path_codes[p])
+            sizes[p] = sizes.get(p, 0) + sum(estimated_edges_size(edges) for edges in key_edges.values())
+            if last_trace_indices[p] == i: final_paths.append(p)
+        for p in final_paths: finalize(p)
+        if sum(sizes.values()) > max_size: spill()
+      yield results.pop(key)
+
+
+def estimated_edges_size(edges):
+  'A rough estimate of the memory held by recorded edges: bitmap bytes, or about 100 bytes per set entry and tuple.'
+  return len(edges) if is_edge_bits(edges) else len(edges) * 100
+
+
+def report(target_path_lists, path_code_edges, args, sampled=0, results=None, profile=None):
+  '''
+  Print the coverage report, and write any requested exports as each path is reported (see `open_exporters`);
+  return the total stats.
+  If `results` is provided, it is an iterator of (text, stats, export, cache_misses, profile_breakdown)
+  for each reported path, in report order; otherwise each path is analyzed here, either serially or in a process pool.
+  '''
   print('----------------')
   print('Coverage Report:')
+  if sampled:
+    print(f'Note: {sampled} sampled trace(s) contributed; lines not covered may have run in calls that were not sampled.')
+  cache = crawl_cache_for_args(args)
   totals = Stats()
+  exporters = open_exporters(args)
+  if results is None and args.jobs > 1:
+    target_paths = [(target, path) for target, paths in sorted(target_path_lists.items()) for path in paths]
+    results = report_paths_parallel(target_paths, path_code_edges, args)
   for target, paths in sorted(target_path_lists.items()):
     if not paths:
       print(f'\n{target}: NEVER IMPORTED.')
+      for exporter in exporters: exporter.add_never_imported(target)
       continue
     for path in paths:
-      coverage = calculate_coverage(path=path, code_edges=path_code_edges[path], dbg=args.dbg)
-      report_path(target=target, path=path, coverage=coverage, totals=totals, args=args)
+      if results is not None:
+        stdout.flush() # results may be computed lazily, with progress messages on stderr.
+        text, stats, export, misses, breakdown = next(results)
+        stdout.write(text)
+        totals.add(stats)
+        if cache: cache.misses += misses
+        if profile and breakdown: profile.add_breakdown(breakdown)
+      else:
+        coverage = calculate_coverage(path=path, code_edges=path_code_edges[path], dbg=args.dbg, cache=cache,
+          profile=profile, lines=args.lines)
+        start_time = perf_counter()
+        export = report_path(target=target, path=path, coverage=coverage, totals=totals, args=args)
+        if profile: profile.add_report_time(path, perf_counter() - start_time)
+      for exporter in exporters: exporter.add(export)
   if sum(len(paths) for paths in target_path_lists.values()) > 1:
     totals.describe('\nTOTAL', True if args.color else '')
+  for exporter in exporters: exporter.close(totals)
+  if cache:
+    if args.dbg: errSL(f'coven analysis cache: {cache.dir}: {cache.hits} hits; {cache.misses} misses.')
+    if cache.misses: cache.evict()
+  return totals
+
+
+def report_paths_parallel(target_paths, path_code_edges, args):
+  '''
+  Analyze and report each (target, path) pair in a process pool,
+  yielding (text, stats, export, cache_misses, profile_breakdown) in order.
+  Results stream back as they complete, so output for the first files appears while later ones are still in progress.
+  Code objects cannot be pickled, so each path's code edges are sent to the workers in marshal format.
+  '''
+  from concurrent.futures import ProcessPoolExecutor
+  jobs = ((target, path, marshal.dumps(dict(path_code_edges[path])), args) for target, path in target_paths)
+  with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+    yield from executor.map(report_path_job, jobs)
+
+
+def report_path_job(job):
+  'Process pool entry point for `report_paths_parallel`: returns the output and export of `report_path` and the path stats.'
+  target, path, code_edges_data, args = job
+  cache = crawl_cache_for_args(args)
+  profile = CovenProfile(memory=False) if args.profile_coven else None
+  coverage = calculate_coverage(path=path, code_edges=marshal.loads(code_edges_data), dbg=args.dbg, cache=cache,
+    profile=profile, lines=args.lines)
+  text, stats, export = report_path_captured(target=target, path=path, coverage=coverage, args=args, profile=profile)
+  return text, stats, export, (cache.misses if cache else 0), (profile.breakdown() if profile else None)
+
+
+def report_path_captured(target, path, coverage, args, profile=None):
+  'Run `report_path` and return its output text, the path stats, and the export record.'
+  from contextlib import redirect_stdout
+  from io import StringIO
+  stats = Stats()
+  buffer = StringIO()
+  start_time = perf_counter()
+  with redirect_stdout(buffer):
+    export = report_path(target=target, path=path, coverage=coverage, totals=stats, args=args)
+  if profile: profile.add_report_time(path, perf_counter() - start_time)
+  return buffer.getvalue(), stats, export
 
 
-def calculate_coverage(path, code_edges, dbg):
+def calculate_coverage(path, code_edges, dbg, cache=None, profile=None, lines=False):
   '''
   Calculate and return the coverage data structure,
   Which maps line numbers to (required, matched) tuples of sets of (src, dst, code).
   Each set contains Edge tuples.
   An Edge is (prev_offset, offset, code).
   A line is fully covered if (required <= traced).
+  If `profile` is provided, the crawl and matching times of each code object are recorded in it.
+  If `lines` is set, calculate statement coverage instead; see `calculate_line_coverage`.
   '''
+  if lines: return calculate_line_coverage(path=path, code_edges=code_edges, dbg=dbg, profile=profile)
   if dbg: errSL(f'\ncalculate_coverage: {path}:')
 
   all_codes = list(visit_nodes(start_nodes=code_edges, visitor=sub_codes))
@@ -274,35 +2641,494 @@ def calculate_coverage(path, code_edges, dbg):
         coverage[line][cov_idx].add((edge[0], edge[1], code))
 
   for code in all_codes:
+    if profile: start_time = perf_counter()
     traced = code_edges.get(code, {})
     # infer all possible edges.
     # TODO: optimization: if not traces, do not bother analyzing code; instead just add fake required edges for each line start in code.
-    req, opt = crawl_code_insts(path=path, code=code, dbg_name=dbg)
-    if dbg == code.co_name:
-      for edge in sorted(traced): err_edge('traced', edge, code)
-    # match traced to inferred edges.
-    raise_reqs = { edge[1] : (edge, lines) for edge, lines in req.items() if edge[0] == OFF_RAISED }
-    raise_opts = { edge[1] for edge in opt if edge[0] == OFF_RAISED }
-    matched = defaultdict(set) # expected exception edges that matched an actual traced edge.
-    for src, dst, line in traced:
-      edge = (src, dst)
-      if edge in req:
-        matched[edge].add(line)
-      elif dst in raise_reqs:
-        e, l = raise_reqs[dst]
-        matched[e].update(l) # add all the lines (really just one line?) implied by the exception edge.
-      elif not (edge in opt or dst in raise_opts):
-        err_edge('UNEXPECTED:', edge, code)
-        errSL(*raise_reqs)
+    if cache and dbg != code.co_name:
+      req, opt = cache.crawl(path=path, code=code)
+    else:
+      req, opt = crawl_code_insts(path=path, code=code, dbg_name=dbg)
+    if profile: crawl_time = perf_counter()
+    if is_edge_bits(traced):
+      # The bitmap is indexed by edge id, so it matches the required (edge, line) pairs directly.
+      if traced[-1]: errSL(f'coven WARNING: {path}:{code.co_name}: bitmap trace recorded UNEXPECTED edges.')
+      matched = bits_matched_edges(traced, req)
+      if dbg == code.co_name:
+        for edge, lines in sorted(matched.items()):
+          for line in sorted(lines): err_edge('traced', (*edge, line), code)
+    else:
+      if is_line_set(traced):
+        exit(f'coven error: {path}: the trace recorded lines only; report it with `-lines`.')
+      if dbg == code.co_name:
+        for edge in sorted(traced): err_edge('traced', edge, code)
+      matched = set_matched_edges(traced, req, opt, code)
     # assemble final coverage data by line.
     add_edges(req, code, COV_REQ)
     add_edges(matched, code, COV_MATCHED)
+    if profile: profile.add_code_times(path, code, crawl=crawl_time - start_time, match=perf_counter() - crawl_time)
   return coverage
 
 
 COV_REQ, COV_MATCHED = range(2)
 
 
+def set_matched_edges(traced, req, opt, code):
+  'Match the traced (src, dst, line) edges of `code` to the inferred edges; return a map of required edges to lines.'
+  raise_reqs = { edge[1] : (edge, lines) for edge, lines in req.items() if edge[0] == OFF_RAISED }
+  raise_opts = { edge[1] for edge in opt if edge[0] == OFF_RAISED }
+  matched = defaultdict(set) # expected exception edges that matched an actual traced edge.
+  for src, dst, line in traced:
+    edge = (src, dst)
+    if edge in req:
+      matched[edge].add(line)
+    elif dst in raise_reqs:
+      e, l = raise_reqs[dst]
+      matched[e].update(l) # add all the lines (really just one line?) implied by the exception edge.
+    elif not (edge in opt or dst in raise_opts):
+      err_edge('UNEXPECTED:', edge, code)
+      errSL(*raise_reqs)
+  return matched
+
+
+def calculate_line_coverage(path, code_edges, dbg, profile=None):
+  '''
+  Calculate statement coverage, in the form returned by calculate_coverage, without any edge analysis.
+  Each line that starts in the line table of a code object is required once for that code object,
+  as the pseudo-edge (OFF_BEGIN, line, code), and is matched if that code traced the line.
+  Traced records may be line sets, or edge sets and bitmaps from edge traces, whose lines are used.
+  '''
+  from dis import findlinestarts
+  if dbg: errSL(f'\ncalculate_line_coverage: {path}:')
+  coverage = defaultdict(lambda: (set(), set()))
+  for code in visit_nodes(start_nodes=code_edges, visitor=sub_codes):
+    if profile: start_time = perf_counter()
+    traced = traced_lines(code, code_edges.get(code, ()))
+    for _, line in findlinestarts(code):
+      if line is None or line <= 0: continue
+      edge = (OFF_BEGIN, line, code)
+      coverage[line][COV_REQ].add(edge)
+      if line in traced: coverage[line][COV_MATCHED].add(edge)
+    if profile: profile.add_code_times(path, code, crawl=0.0, match=perf_counter() - start_time)
+  return coverage
+
+
+def traced_lines(code, edges, cache=None):
+  'The set of lines in the traced records of `code`: a line set, an edge set (possibly mixed with lines), or a bitmap.'
+  if is_edge_bits(edges):
+    if cache: req, _ = cache.crawl(path=code.co_filename, code=code)
+    else: req, _ = crawl_code_insts(path=code.co_filename, code=code, dbg_name=None)
+    return { line for i, (_, line) in enumerate(req_edge_lines(req)) if edges[i] }
+  return { e if isinstance(e, int) else e[2] for e in edges }
+
+
+def crawl_cache_for_args(args):
+  if args.warm_caches: return args.warm_caches
+  if args.no_cache or not args.cache_dir: return None
+  return CrawlCache(args.cache_dir, max_size=int(args.cache_size * 1000000))
+
+
+# The analysis cache is opt-in: it is only used if this variable or `-cache-dir` names a directory.
+CACHE_DIR_ENV_VAR = 'COVEN_CACHE_DIR'
+
+
+class CrawlCache:
+  '''
+  Persistent cache of `crawl_code_insts` results, stored as one marshaled (req, opt) file per code object.
+  Entries are keyed by the `code_digest` of the code object (which covers the bytecode, constants, names and line table)
+  and the interpreter version; nested code objects are part of the key, so an edit invalidates the enclosing code too.
+  File modification times record use, and the least recently used entries are evicted to keep the total under `max_size`:
+  by `evict`, and also whenever the entries written since the last eviction exceed an eighth of `max_size`,
+  so that long runs (indexing, the daemon) stay bounded too.
+  '''
+
+  version = 2 # Increment whenever a change to crawl_code_insts (or to the key) alters the results.
+
+  def __init__(self, dir, max_size):
+    self.dir = dir
+    self.max_size = max_size
+    self.hits = 0
+    self.misses = 0
+    self.unevicted_size = 0 # The size of the entries written since the last eviction.
+
+  def key(self, code):
+    from hashlib import blake2b
+    h = blake2b(f'coven-crawl-{self.version} {sys.version}'.encode(), digest_size=20)
+    h.update(code_digest(code))
+    return h.hexdigest()
+
+  def crawl(self, path, code):
+    key = self.key(code)
+    entry_path = path_join(self.dir, key[:2], key)
+    try:
+      with open(entry_path, 'rb') as f: req, opt = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError): pass # missing or corrupt entries are recomputed.
+    else:
+      self.hits += 1
+      try: os.utime(entry_path)
+      except OSError: pass
+      return req, opt
+    self.misses += 1
+    req, opt = crawl_code_insts(path=path, code=code, dbg_name=None)
+    try:
+      os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+      tmp_path = f'{entry_path}.{os.getpid()}.tmp'
+      with open(tmp_path, 'wb') as f:
+        marshal.dump((dict(req), dict(opt)), f)
+        self.unevicted_size += f.tell()
+      os.replace(tmp_path, entry_path) # atomic, so that concurrent reports never read a partial entry.
+    except OSError as e:
+      errSL(f'coven WARNING: could not write analysis cache entry: {entry_path}: {e}')
+    if self.unevicted_size > self.max_size // 8: self.evict()
+    return req, opt
+
+  def evict(self):
+    self.unevicted_size = 0
+    entries = []
+    total = 0
+    try: subdirs = [e.path for e in os.scandir(self.dir) if e.is_dir()]
+    except OSError: return
+    for subdir in subdirs:
+      for e in os.scandir(subdir):
+        st = e.stat()
+        entries.append((st.st_mtime, st.st_size, e.path))
+        total += st.st_size
+    if total <= self.max_size: return
+    entries.sort()
+    for _, size, entry_path in entries:
+      try: os.remove(entry_path)
+      except OSError: continue
+      total -= size
+      if total <= self.max_size: break
+
+
+class WarmCaches:
+  '''
+  In-memory caches that the analysis daemon keeps across requests (see `serve_daemon`):
+  * crawls: `crawl_code_insts` results keyed by `code_digest`, backed by the persistent `CrawlCache`, if any;
+  * sources: the line texts and ignored line sets of each source path, stamped with its mtime, size and digest.
+  This implements the `CrawlCache` interface used by `calculate_coverage` and `report`.
+  A source entry is revalidated on every use: if the mtime or size changed, the file is reread,
+  and if its digest changed, the entry is recomputed and the crawls recorded for the path are dropped.
+  Each cache holds at most `max_entries` entries, and evicts the least recently used.
+  '''
+
+  def __init__(self, max_entries, disk=None):
+    from collections import OrderedDict
+    self.max_entries = max_entries
+    self.disk = disk
+    self.dir = disk.dir if disk else 'memory'
+    self.crawls = OrderedDict() # code_digest -> (req, opt).
+    self.path_crawl_keys = defaultdict(set) # source path -> crawls keys.
+    self.sources = OrderedDict() # path -> (stamp, digest, line_texts, ignored_lines, explicitly_ignored_lines).
+    self.hits = 0
+    self.misses = 0
+    self.source_hits = 0
+    self.source_misses = 0
+
+  def crawl(self, path, code):
+    key = code_digest(code)
+    try: entry = self.crawls[key]
+    except KeyError: pass
+    else:
+      self.crawls.move_to_end(key)
+      self.hits += 1
+      return entry
+    self.misses += 1
+    entry = self.disk.crawl(path, code) if self.disk else crawl_code_insts(path=path, code=code, dbg_name=None)
+    self.crawls[key] = entry
+    self.path_crawl_keys[path].add(key)
+    if len(self.crawls) > self.max_entries: self.crawls.popitem(last=False)
+    return entry
+
+  def evict(self):
+    if self.disk and self.disk.misses:
+      self.disk.evict()
+      self.disk.misses = 0
+
+  def source(self, path):
+    'Return the line texts, ignored and explicitly ignored line sets of `path`; see `read_source`.'
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size)
+    entry = self.sources.get(path)
+    if entry and entry[0] == stamp:
+      self.sources.move_to_end(path)
+      self.source_hits += 1
+      return entry[2:]
+    from hashlib import blake2b
+    from io import BytesIO, TextIOWrapper
+    with open(path, 'rb') as f: data = f.read()
+    digest = blake2b(data, digest_size=16).digest()
+    if entry and entry[1] == digest: # touched but unchanged.
+      self.source_hits += 1
+      result = entry[2:]
+    else:
+      self.source_misses += 1
+      if entry:
+        for key in self.path_crawl_keys.pop(path, ()): self.crawls.pop(key, None)
+      line_texts = [text.rstrip() for text in TextIOWrapper(BytesIO(data)).readlines()]
+      result = (line_texts, *calc_ignored_lines(line_texts))
+    self.sources[path] = (stamp, digest, *result)
+    self.sources.move_to_end(path)
+    if len(self.sources) > self.max_entries:
+      evicted, _ = self.sources.popitem(last=False)
+      self.path_crawl_keys.pop(evicted, None)
+    return result
+
+  def stats(self):
+    return dict(crawls=len(self.crawls), crawl_hits=self.hits, crawl_misses=self.misses,
+      sources=len(self.sources), source_hits=self.source_hits, source_misses=self.source_misses)
+
+
+daemon_requests = ('report', 'summary', 'stats', 'shutdown')
+
+# The report options that a client may set for each daemon request; all others are those of the daemon.
+daemon_request_options = ('show_all', 'color', 'lines', 'stream_mem', 'json_lines', 'lcov', 'cobertura')
+
+
+def serve_daemon(socket_path, args):
+  '''
+  Serve requests on the Unix socket at `socket_path`, one at a time, until a 'shutdown' request,
+  keeping analyses and sources warm in memory across requests (see `WarmCaches`).
+  Each connection carries a single request and its response, each one line of JSON.
+  A request is a dict with 'cmd' (one of `daemon_requests`), and for 'report' and 'summary':
+  * 'cwd': the client directory, relative to which paths are resolved and reported;
+  * 'targets': the expanded target names;
+  * 'traces': trace file paths; and/or 'payloads': base64 encoded trace file contents;
+  * 'options': report options (see `daemon_request_options`).
+  The response has 'ok', and 'error' if it is false; 'out' and 'err', the output of the request;
+  'totals' for 'report' and 'summary' requests, whose 'out' is omitted; and 'stats' for 'stats' requests.
+  '''
+  import socket
+  from json import dumps, loads
+  if os.path.exists(socket_path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+      try: probe.connect(socket_path)
+      except OSError: os.remove(socket_path) # stale socket from a daemon that did not exit cleanly.
+      else: exit(f'coven error: a daemon is already listening on socket: {socket_path}')
+  server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  server.bind(socket_path)
+  server.listen()
+  warm_caches = WarmCaches(max_entries=args.daemon_entries, disk=crawl_cache_for_args(args))
+  errSL(f'coven daemon: listening on {socket_path}.')
+  try:
+    is_running = True
+    while is_running:
+      conn, _ = server.accept()
+      with conn, conn.makefile('rwb') as f:
+        try: request = loads(f.readline())
+        except ValueError as e:
+          response = dict(ok=False, error=f'coven error: malformed daemon request: {e}')
+        else:
+          is_running = request.get('cmd') != 'shutdown'
+          response = handle_daemon_request(request, args, warm_caches)
+        try:
+          f.write(dumps(response).encode())
+          f.write(b'\n')
+          f.flush()
+        except OSError as e: errSL(f'coven daemon: could not send response: {e}')
+  except KeyboardInterrupt: pass
+  finally:
+    server.close()
+    os.remove(socket_path)
+  errSL('coven daemon: stopped.')
+
+
+def handle_daemon_request(request, daemon_args, warm_caches):
+  'Handle a single daemon request; see `serve_daemon`.'
+  cmd = request.get('cmd')
+  if cmd == 'shutdown': return dict(ok=True)
+  if cmd == 'stats': return dict(ok=True, stats=warm_caches.stats())
+  if cmd not in ('report', 'summary'): return dict(ok=False, error=f'coven error: unknown daemon request: {cmd!r}')
+  from argparse import Namespace
+  from base64 import b64decode
+  from io import StringIO
+  from shutil import rmtree
+  from tempfile import mkdtemp
+  args = Namespace(**vars(daemon_args))
+  for name, val in request.get('options', {}).items():
+    if name in daemon_request_options: setattr(args, name, val)
+  args.jobs = 1 # the warm caches are only useful in this process.
+  args.progress = False
+  args.profile_coven = None
+  args.warm_caches = warm_caches
+  out = StringIO()
+  err = StringIO()
+  response = dict(ok=True)
+  orig_cwd = os.getcwd()
+  payload_dir = None
+  try:
+    os.chdir(request['cwd'])
+    trace_paths = list(request.get('traces', ()))
+    for i, payload in enumerate(request.get('payloads', ())):
+      if payload_dir is None: payload_dir = mkdtemp(prefix='coven-daemon-')
+      trace_path = path_join(payload_dir, f'{i}.trace')
+      with open(trace_path, 'wb') as f: f.write(b64decode(payload))
+      trace_paths.append(trace_path)
+    with RedirectedOutput(out, err):
+      totals = coalesce(trace_paths=trace_paths, arg_targets=set(request.get('targets', ())), args=args)
+    response['totals'] = vars(totals)
+  except SystemExit as e: # coven reports errors by calling `exit`.
+    response = dict(ok=False, error=str(e.code))
+  except Exception as e:
+    from traceback import format_exc
+    response = dict(ok=False, error=f'coven daemon error: {e!r}\n{format_exc()}')
+  finally:
+    os.chdir(orig_cwd)
+    if payload_dir: rmtree(payload_dir, ignore_errors=True)
+  if cmd == 'report': response['out'] = out.getvalue()
+  response['err'] = err.getvalue()
+  return response
+
+
+class RedirectedOutput:
+  '''
+  Context manager that redirects standard output and error to `out` and `err`,
+  including the references to them that this module imported from `sys`.
+  '''
+
+  def __init__(self, out, err):
+    self.out = out
+    self.err = err
+    self.orig = None
+
+  def __enter__(self):
+    g = globals()
+    self.orig = (sys.stdout, sys.stderr, g['stdout'], g['stderr'])
+    sys.stdout = g['stdout'] = self.out
+    sys.stderr = g['stderr'] = self.err
+    return self
+
+  def __exit__(self, *exc_info):
+    g = globals()
+    sys.stdout, sys.stderr, g['stdout'], g['stderr'] = self.orig
+
+
+def daemon_client(socket_path, arg_targets, args):
+  'Send the request given by `args` to the daemon at `socket_path`, and print its output.'
+  import socket
+  from json import dumps, loads
+  cmd = args.daemon_request
+  request = dict(cmd=cmd)
+  if cmd in ('report', 'summary'):
+    request.update(cwd=os.getcwd(), targets=sorted(arg_targets), traces=args.coalesce,
+      options={ name : getattr(args, name) for name in daemon_request_options })
+  with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+    try: s.connect(socket_path)
+    except OSError as e: exit(f'coven error: could not connect to daemon: {socket_path}: {e}')
+    s.sendall(dumps(request).encode() + b'\n')
+    with s.makefile('rb') as f: line = f.readline()
+  if not line: exit(f'coven error: daemon closed the connection without responding: {socket_path}')
+  response = loads(line)
+  stderr.write(response.get('err', ''))
+  if not response['ok']: exit(response['error'])
+  if cmd == 'report':
+    stdout.write(response['out'])
+  elif cmd == 'summary':
+    totals = Stats()
+    totals.__dict__.update(response['totals'])
+    totals.describe('TOTAL', True if args.color else '')
+  elif cmd == 'stats':
+    print('; '.join(f'{val} {name.replace("_", " ")}' for name, val in response['stats'].items()), '.', sep='')
+
+
+def profile_phase(profile, name):
+  'Return a context manager that measures the phase `name` in `profile`, or does nothing if `profile` is None.'
+  if profile: return profile.phase(name)
+  from contextlib import nullcontext
+  return nullcontext()
+
+
+class CovenProfile:
+  '''
+  Measurements of coven's own cost, for `-profile-coven`:
+  wall time, CPU time and traced memory for each phase of the run,
+  and per-file and per-code-object breakdowns of analysis time (crawl, edge matching, and report formatting).
+  Memory is measured with tracemalloc, which is started when `memory` is set, and which slows down the traced program.
+  Where `tracemalloc.reset_peak` is available (Python 3.9+) the peak is per phase; otherwise it is the peak so far.
+  CPU time is for this process only, so the work of `-jobs` workers appears only in wall time and the breakdowns.
+  '''
+  summary_limit = 10 # Number of slowest files and code objects in the stderr summary.
+
+  def __init__(self, memory=True):
+    self.memory = memory
+    if memory:
+      import tracemalloc
+      tracemalloc.start()
+    self.phases = [] # Dicts of name, wall, cpu, and (if memory is set) mem_current and mem_peak.
+    self.files = {} # Maps paths to dicts of seconds (crawl, match, report) and the number of codes.
+    self.codes = {} # Maps 'path:line:name' to dicts of seconds (crawl, match).
+
+  def phase(self, name):
+    from contextlib import contextmanager
+    @contextmanager
+    def measure():
+      if self.memory:
+        import tracemalloc
+        try: tracemalloc.reset_peak()
+        except AttributeError: pass
+      start_wall = perf_counter()
+      start_cpu = process_time()
+      try: yield
+      finally:
+        record = dict(name=name, wall=perf_counter() - start_wall, cpu=process_time() - start_cpu)
+        if self.memory: record['mem_current'], record['mem_peak'] = tracemalloc.get_traced_memory()
+        self.phases.append(record)
+    return measure()
+
+  def file_times(self, path):
+    try: return self.files[path]
+    except KeyError:
+      times = self.files[path] = dict(crawl=0.0, match=0.0, report=0.0, codes=0)
+      return times
+
+  def add_code_times(self, path, code, crawl, match):
+    file_times = self.file_times(path)
+    file_times['crawl'] += crawl
+    file_times['match'] += match
+    file_times['codes'] += 1
+    key = f'{path}:{code.co_firstlineno}:{code.co_name}'
+    code_times = self.codes.setdefault(key, dict(crawl=0.0, match=0.0)) # lambdas on one line share a key.
+    code_times['crawl'] += crawl
+    code_times['match'] += match
+
+  def add_report_time(self, path, report):
+    self.file_times(path)['report'] += report
+
+  def breakdown(self):
+    return dict(files=self.files, codes=self.codes)
+
+  def add_breakdown(self, breakdown):
+    'Add the breakdown of another profile, e.g. from a `-jobs` worker.'
+    for path, times in breakdown['files'].items():
+      file_times = self.file_times(path)
+      for k, v in times.items(): file_times[k] += v
+    for key, times in breakdown['codes'].items():
+      code_times = self.codes.setdefault(key, dict(crawl=0.0, match=0.0))
+      for k, v in times.items(): code_times[k] += v
+
+  def emit(self, dst):
+    'Print a summary to stderr if `dst` is "-"; otherwise write the full profile to `dst` as JSON.'
+    if dst != '-':
+      import json
+      with open(dst, 'w') as f:
+        json.dump(dict(version=1, python=sys.version, phases=self.phases, **self.breakdown()), f, indent=1, sort_keys=True)
+        f.write('\n')
+      return
+    errSL('coven profile:')
+    errSL(f'  {"phase":<18} {"wall s":>9} {"cpu s":>9} {"peak MB":>9}')
+    for p in self.phases:
+      peak = f'{p["mem_peak"] / 1000000:9.3f}' if 'mem_peak' in p else f'{"-":>9}'
+      errSL(f'  {p["name"]:<18} {p["wall"]:9.3f} {p["cpu"]:9.3f} {peak}')
+    def total(times): return times['crawl'] + times['match'] + times.get('report', 0)
+    for label, items in (('files', self.files), ('code objects', self.codes)):
+      if not items: continue
+      errSL(f'  slowest {label} (total = crawl + match{" + report" if label == "files" else ""} seconds):')
+      for name, times in sorted(items.items(), key=lambda item: total(item[1]), reverse=True)[:self.summary_limit]:
+        parts = f'{times["crawl"]:.4f} + {times["match"]:.4f}' + (f' + {times["report"]:.4f}' if 'report' in times else '')
+        errSL(f'    {total(times):8.4f} = {parts}  {name}')
+
+
 def visit_nodes(start_nodes, visitor):
   remaining = set(start_nodes)
   visited = set()
@@ -339,16 +3165,24 @@ def enhance_inst(inst, off, line, is_line_start, stack):
   inst.is_exc_match_jmp_dst = False
 
 
-_begin_inst = Instruction(opname='_BEGIN', opcode=OP_BEGIN, arg=None, argval=None, argrepr=None,
-  offset=OFF_BEGIN, starts_line=LINE_BEGIN, is_jump_target=False)
-enhance_inst(_begin_inst, off=OFF_BEGIN, line=LINE_BEGIN, is_line_start=False, stack=())
+_begin_inst = _raised_inst = None # The sentinel instructions; created by `make_sentinel_insts`.
 
-_raised_inst = Instruction(opname='_RAISED', opcode=OP_RAISED, arg=None, argval=None, argrepr=None,
-  offset=OFF_RAISED, starts_line=LINE_RAISED, is_jump_target=False)
-enhance_inst(_raised_inst, off=OFF_RAISED, line=LINE_RAISED, is_line_start=False, stack=())
+def make_sentinel_insts():
+  'Create the sentinel instructions on first use, so that `dis` is not imported until code is crawled.'
+  global _begin_inst, _raised_inst
+  if _begin_inst is not None: return
+  from dis import Instruction
+  _begin_inst = Instruction(opname='_BEGIN', opcode=OP_BEGIN, arg=None, argval=None, argrepr=None,
+    offset=OFF_BEGIN, starts_line=LINE_BEGIN, is_jump_target=False)
+  enhance_inst(_begin_inst, off=OFF_BEGIN, line=LINE_BEGIN, is_line_start=False, stack=())
+  _raised_inst = Instruction(opname='_RAISED', opcode=OP_RAISED, arg=None, argval=None, argrepr=None,
+    offset=OFF_RAISED, starts_line=LINE_RAISED, is_jump_target=False)
+  enhance_inst(_raised_inst, off=OFF_RAISED, line=LINE_RAISED, is_line_start=False, stack=())
 
 
 def crawl_code_insts(path, code, dbg_name):
+  from dis import get_instructions
+  make_sentinel_insts()
   name = code.co_name
   dbg = (name == dbg_name)
   if dbg: errSL(f'\ncrawl code: {path}:{name}')
@@ -749,9 +3583,9 @@ class Stats:
 
 
 def report_path(target, path, coverage, totals, args):
+  'Print the report for `path` and add its stats to `totals`; return its export record if exports are requested.'
 
-  line_texts = [text.rstrip() for text in open(path).readlines()]
-  ignored_lines, explicitly_ignored_lines = calc_ignored_lines(line_texts)
+  line_texts, ignored_lines, explicitly_ignored_lines = read_source(path, warm_caches=args.warm_caches)
 
   covered_lines = set() # line indices that are perfectly covered.
   ign_cov_lines = set()
@@ -778,13 +3612,16 @@ def report_path(target, path, coverage, totals, args):
   stats.not_covered = len(not_cov_lines)
   stats.ignored = len(ignored_lines - covered_lines - ign_cov_lines - not_cov_lines)
   totals.add(stats)
+  export = None
+  if is_export_requested(args):
+    export = export_record(target, path, coverage, stats, ignored_lines, covered_lines, ign_cov_lines)
 
   c = True if args.color else ''
   rel_path = path_rel_to_current_or_abs(path)
   label = f'\n{target}: {rel_path}'
   if not problem_lines:
     stats.describe(label, c)
-    return
+    return export
 
   RST1 = c and RST
   TXT_B1 = c and TXT_B
@@ -834,6 +3671,186 @@ def report_path(target, path, coverage, totals, args):
         err_cov_set(f'{TXT_D1}{line:4} {TXT_B1}-', required - matched, args.dbg)
         err_cov_set(f'{TXT_D1}{line:4} {TXT_B1}=', matched, args.dbg)
   stats.describe(label, c)
+  return export
+
+
+def export_record(target, path, coverage, stats, ignored_lines, covered_lines, ign_cov_lines):
+  '''
+  The export record for a reported path: a dict of target, path, stats (as a dict),
+  and 'lines': a [line, status, required_edges, matched_edges, edge_hits] list for each traceable line, in order,
+  where status is 'covered', 'partial', 'not_covered', 'ignored' or 'ignored_but_covered',
+  and edge_hits is a 0 or 1 for each required edge of the line, in `export_edge_key` order.
+  '''
+  lines = []
+  for line in sorted(coverage):
+    required, matched = coverage[line]
+    if line in ign_cov_lines: status = 'ignored_but_covered'
+    elif line in covered_lines: status = 'covered'
+    elif line in ignored_lines: status = 'ignored'
+    elif matched: status = 'partial'
+    else: status = 'not_covered'
+    edge_hits = [int(edge in matched) for edge in sorted(required, key=export_edge_key)]
+    lines.append([line, status, len(required), len(matched), edge_hits])
+  return dict(target=target, path=path, stats=dict(vars(stats)), lines=lines)
+
+
+def export_edge_key(edge):
+  '''
+  The order of the required edges of a line in export records: by code object, then offsets.
+  The index of an edge in this order identifies it for as long as the source of its code is unchanged.
+  '''
+  src, dst, code = edge
+  return (code.co_firstlineno, code.co_name, src, dst)
+
+
+def is_export_requested(args): return bool(args.json_lines or args.lcov or args.cobertura)
+
+
+def open_exporters(args):
+  '''
+  Open the exporters requested by `args`.
+  Each exporter writes out the export record of each path as soon as it is reported, and keeps only running counts,
+  so that exporting runs in constant memory; `close` writes the totals.
+  '''
+  exporters = []
+  if args.json_lines: exporters.append(JSONLinesExporter(args.json_lines))
+  if args.lcov: exporters.append(LcovExporter(args.lcov))
+  if args.cobertura: exporters.append(CoberturaExporter(args.cobertura))
+  return exporters
+
+
+def export_line_hits(record):
+  '''
+  Yield (line, hits, required_edges, matched_edges, edge_hits) for each line of an export record that is not ignored.
+  A line counts as hit if any of its edges was traced; lines that are only partially covered
+  are distinguished by their edges, which the LCOV and Cobertura exporters report as branches.
+  '''
+  for line, status, required, matched, edge_hits in record['lines']:
+    if status == 'ignored': continue
+    yield line, int(matched > 0), required, min(matched, required), edge_hits
+
+
+def export_rate(numerator, denominator): return f'{numerator / denominator:.4f}' if denominator else '1'
+
+
+class JSONLinesExporter:
+  '''
+  Writes one JSON object per line: a 'file' record for each reported path (see `export_record`),
+  a 'never_imported' record for each target that was never imported, and a final 'totals' record with the total stats.
+  '''
+
+  def __init__(self, path):
+    from json import JSONEncoder
+    self.encode = JSONEncoder(separators=(',', ':')).encode
+    self.file = open(path, 'w')
+
+  def write(self, record):
+    self.file.write(self.encode(record))
+    self.file.write('\n')
+
+  def add(self, record): self.write(dict(type='file', **record))
+
+  def add_never_imported(self, target): self.write(dict(type='never_imported', target=target))
+
+  def close(self, totals):
+    self.write(dict(type='totals', stats=dict(vars(totals))))
+    self.file.close()
+
+
+class LcovExporter:
+  '''
+  Writes an LCOV tracefile section for each reported path; see `export_line_hits`.
+  A line with more than one required edge gets a branch (BRDA) for each edge, numbered by its index in the
+  `export_edge_key` order, and taken if that edge was traced; the branches of a line that never ran are marked '-'.
+  '''
+
+  def __init__(self, path):
+    self.file = open(path, 'w')
+
+  def add(self, record):
+    write = self.file.write
+    write(f'TN:\nSF:{record["path"]}\n')
+    line_hits = list(export_line_hits(record))
+    branches_found = branches_hit = 0
+    for line, hits, _, _, edge_hits in line_hits:
+      if len(edge_hits) < 2: continue
+      for i, hit in enumerate(edge_hits):
+        write(f'BRDA:{line},0,{i},{hit if hits else "-"}\n')
+      branches_found += len(edge_hits)
+      if hits: branches_hit += sum(edge_hits) # the BRDA records that are taken.
+    write(f'BRF:{branches_found}\nBRH:{branches_hit}\n')
+    for line, hits, _, _, _ in line_hits:
+      write(f'DA:{line},{hits}\n')
+    write(f'LF:{len(line_hits)}\nLH:{sum(hits for _, hits, _, _, _ in line_hits)}\nend_of_record\n')
+
+  def add_never_imported(self, target): pass
+
+  def close(self, totals): self.file.close()
+
+
+class CoberturaExporter:
+  '''
+  Writes Cobertura XML, with a class for each reported path, all in a single package.
+  The root element carries the totals, so classes are streamed to a temporary file,
+  which is copied into place after the root element once the report is complete.
+  Line hits and branch conditions are derived as for LCOV; see `export_line_hits`.
+  '''
+
+  def __init__(self, path):
+    from tempfile import TemporaryFile
+    self.path = path
+    self.body = TemporaryFile('w+')
+    self.lines_valid = 0
+    self.lines_covered = 0
+    self.branches_valid = 0
+    self.branches_covered = 0
+
+  def add(self, record):
+    from xml.sax.saxutils import quoteattr
+    write = self.body.write
+    line_hits = list(export_line_hits(record))
+    lines_covered = sum(hits for _, hits, _, _, _ in line_hits)
+    branches_valid = sum(len(edge_hits) for _, _, _, _, edge_hits in line_hits if len(edge_hits) > 1)
+    branches_covered = sum(sum(edge_hits) for _, _, _, _, edge_hits in line_hits if len(edge_hits) > 1)
+    self.lines_valid += len(line_hits)
+    self.lines_covered += lines_covered
+    self.branches_valid += branches_valid
+    self.branches_covered += branches_covered
+    rel_path = path_rel_to_current_or_abs(record['path'])
+    name = os.path.splitext(rel_path)[0].replace(os.sep, '.')
+    write(f'<class name={quoteattr(name)} filename={quoteattr(rel_path)} '
+      f'line-rate="{export_rate(lines_covered, len(line_hits))}" '
+      f'branch-rate="{export_rate(branches_covered, branches_valid)}" complexity="0">\n<methods/>\n<lines>\n')
+    for line, hits, _, _, edge_hits in line_hits:
+      if len(edge_hits) > 1:
+        taken = sum(edge_hits)
+        write(f'<line number="{line}" hits="{hits}" branch="true" '
+          f'condition-coverage="{100 * taken // len(edge_hits)}% ({taken}/{len(edge_hits)})"/>\n')
+      else:
+        write(f'<line number="{line}" hits="{hits}" branch="false"/>\n')
+    write('</lines>\n</class>\n')
+
+  def add_never_imported(self, target): pass
+
+  def close(self, totals):
+    from shutil import copyfileobj
+    from time import time
+    from xml.sax.saxutils import escape
+    line_rate = export_rate(self.lines_covered, self.lines_valid)
+    branch_rate = export_rate(self.branches_covered, self.branches_valid)
+    with open(self.path, 'w') as f:
+      f.write('<?xml version="1.0" ?>\n'
+        '<!DOCTYPE coverage SYSTEM "http://cobertura.sourceforge.net/xml/coverage-04.dtd">\n'
+        f'<coverage line-rate="{line_rate}" branch-rate="{branch_rate}" '
+        f'lines-covered="{self.lines_covered}" lines-valid="{self.lines_valid}" '
+        f'branches-covered="{self.branches_covered}" branches-valid="{self.branches_valid}" '
+        f'complexity="0" version="coven" timestamp="{int(time() * 1000)}">\n'
+        f'<sources>\n<source>{escape(abs_path("."))}</source>\n</sources>\n'
+        f'<packages>\n<package name="" line-rate="{line_rate}" branch-rate="{branch_rate}" complexity="0">\n<classes>\n')
+      self.body.seek(0)
+      copyfileobj(self.body, f)
+      f.write('</classes>\n</package>\n</packages>\n</coverage>\n')
+    self.body.close()
 
 
 def path_rel_to_current_or_abs(path: str) -> str:
@@ -854,15 +3871,26 @@ def path_comps(path: str):
   return [comp or '/' for comp in np.split(os.sep)]
 
 
-indent_and_ignored_re = re.compile(r'''(?x:
+# Regular expressions are compiled by the functions that use them (`re` caches them),
+# so that tracing does not pay for compiling them at startup.
+indent_and_ignored_pattern = r'''(?x:
 (\s*) # capture leading space.
 ( .* (?P<directive> \#!cov-ignore )
 | assert\b
 | if \s+ __name__ \s* == \s* ['"]__main__['"] \s* :
 )?
-)''')
+)'''
+
+def read_source(path, warm_caches=None):
+  'Return the line texts of the source at `path`, and its ignored and explicitly ignored line sets.'
+  if warm_caches: return warm_caches.source(path)
+  line_texts = [text.rstrip() for text in open(path).readlines()]
+  return (line_texts, *calc_ignored_lines(line_texts))
+
 
 def calc_ignored_lines(line_texts):
+  import re
+  indent_and_ignored_re = re.compile(indent_and_ignored_pattern)
   explicit = set()
   implicit = set()
   indent = -1
@@ -951,16 +3979,21 @@ CALL_FUNCTION         = opmap['CALL_FUNCTION']
 COMPARE_OP            = opmap['COMPARE_OP']
 DELETE_FAST           = opmap['DELETE_FAST']
 DUP_TOP               = opmap['DUP_TOP']
+DUP_TOP_TWO           = opmap['DUP_TOP_TWO']
 END_FINALLY           = opmap['END_FINALLY']
 EXTENDED_ARG          = opmap['EXTENDED_ARG']
 LOAD_CONST            = opmap['LOAD_CONST']
 LOAD_GLOBAL           = opmap['LOAD_GLOBAL']
+NOP                   = opmap['NOP']
 POP_BLOCK             = opmap['POP_BLOCK']
 POP_EXCEPT            = opmap['POP_EXCEPT']
 POP_TOP               = opmap['POP_TOP']
 RAISE_VARARGS         = opmap['RAISE_VARARGS']
 RETURN_VALUE          = opmap['RETURN_VALUE']
+ROT_THREE             = opmap['ROT_THREE']
+ROT_TWO               = opmap['ROT_TWO']
 STORE_FAST            = opmap['STORE_FAST']
+STORE_SUBSCR          = opmap['STORE_SUBSCR']
 WITH_CLEANUP_FINISH   = opmap['WITH_CLEANUP_FINISH']
 WITH_CLEANUP_START    = opmap['WITH_CLEANUP_START']
 YIELD_FROM            = opmap['YIELD_FROM']
@@ -990,6 +4023,29 @@ stop_opcodes = {
   YIELD_FROM,
 }
 
+# the following opcodes never raise an exception.
+# an instruction that also has a single successor always takes the edge to it, so the probes engine folds that edge.
+nonraising_opcodes = {
+  BREAK_LOOP,
+  CONTINUE_LOOP,
+  DUP_TOP,
+  DUP_TOP_TWO,
+  JUMP_ABSOLUTE,
+  JUMP_FORWARD,
+  LOAD_CONST,
+  NOP,
+  POP_BLOCK,
+  POP_EXCEPT,
+  POP_TOP,
+  RETURN_VALUE,
+  ROT_THREE,
+  ROT_TWO,
+  SETUP_EXCEPT,
+  SETUP_FINALLY,
+  SETUP_LOOP,
+  STORE_FAST,
+}
+
 # the following opcodes trigger 'return' events.
 return_opcodes = {
   RETURN_VALUE,
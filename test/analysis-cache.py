@@ -0,0 +1,50 @@
+# Test that the analysis cache is only used when enabled, that warm reports match cold ones, and that it stays bounded.
+
+import os
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+
+
+coven_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'coven.py')
+
+
+def coven(*args, env):
+  r = subprocess.run([sys.executable, coven_path, *args, '--', 'inline_{}.py', '0'], env=env,
+    stdout=subprocess.PIPE, universal_newlines=True, check=True)
+  return r.stdout.splitlines()[-1].partition(': ')[2]
+
+
+def cache_entries(dir):
+  return sorted(os.path.join(d, name) for d, _, names in os.walk(dir) for name in names)
+
+
+def main():
+  with TemporaryDirectory() as dir:
+    home = os.path.join(dir, 'home')
+    cache_dir = os.path.join(dir, 'cache')
+    os.mkdir(home)
+    env = dict(os.environ, HOME=home, XDG_CACHE_HOME=os.path.join(home, '.cache'))
+    env.pop('COVEN_CACHE_DIR', None)
+
+    print('default:', coven(env=env))
+    print('home entries:', len(cache_entries(home)))
+
+    print('cold:', coven('-cache-dir', cache_dir, env=env))
+    entries = cache_entries(cache_dir)
+    print('entries written:', len(entries) > 0)
+    print('warm:', coven('-cache-dir', cache_dir, env=env))
+    print('entries unchanged:', cache_entries(cache_dir) == entries)
+
+    env_enabled = dict(env, COVEN_CACHE_DIR=os.path.join(dir, 'env-cache'))
+    print('env:', coven(env=env_enabled))
+    print('env entries written:', len(cache_entries(env_enabled['COVEN_CACHE_DIR'])) > 0)
+    print('no-cache:', coven('-no-cache', '-cache-dir', os.path.join(dir, 'disabled'), env=env))
+    print('disabled entries:', len(cache_entries(os.path.join(dir, 'disabled'))))
+
+    small_dir = os.path.join(dir, 'small')
+    print('small:', coven('-cache-dir', small_dir, '-cache-size', '0.0001', env=env))
+    print('small size within bound:', sum(os.path.getsize(p) for p in cache_entries(small_dir)) <= 100)
+
+
+if __name__ == '__main__': main()
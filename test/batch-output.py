@@ -0,0 +1,37 @@
+# Test that batch commands print their mixed stdout and stderr in command order:
+# a command that starts after the previous ones have finished writes directly, keeping the interleaving of its output,
+# while a command that runs ahead of another is buffered, and its stdout precedes its stderr.
+# The batch runs in its own coven process, which forks the workers.
+
+import os
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+
+
+coven_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'coven.py')
+
+job_script = '''
+import sys
+for i in range(2):
+  print(sys.argv[1], 'out', i, flush=True)
+  print(sys.argv[1], 'err', i, file=sys.stderr, flush=True)
+'''
+
+
+def main():
+  with TemporaryDirectory() as dir:
+    script_path = os.path.join(dir, 'job.py')
+    with open(script_path, 'w') as f: f.write(job_script)
+    jobs_path = os.path.join(dir, 'jobs.txt')
+    with open(jobs_path, 'w') as f:
+      for name in ('a', 'b'): print(script_path, name, file=f)
+    for jobs in ('1', '2'):
+      print('-jobs', jobs)
+      r = subprocess.run([sys.executable, coven_path, '-batch', jobs_path, '-jobs', jobs,
+        '-output', os.path.join(dir, 'all.cov')], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        universal_newlines=True, check=True)
+      print(r.stdout, end='')
+
+
+if __name__ == '__main__': main()
@@ -0,0 +1,47 @@
+# Test that traces recorded by separate processes, in either format, coalesce to the same result.
+# Each trace is recorded by its own coven process, so the traced code objects are loaded independently.
+# Small coalesces load their traces serially even with `-jobs`, so the parallel loader is also compared directly.
+
+import os
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+
+
+root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+coven_path = os.path.join(root_dir, 'coven.py')
+
+parallel_check = '''
+import sys
+from argparse import Namespace
+import coven
+serial = coven.load_traces(sys.argv[1:], arg_targets=[])
+parallel = coven.load_traces_parallel(sys.argv[1:], [], None, Namespace(jobs=2, progress=False))
+print('parallel load matches serial:', parallel == serial)
+'''
+
+
+def coven(*args):
+  r = subprocess.run([sys.executable, coven_path, *args], stdout=subprocess.PIPE, universal_newlines=True, check=True)
+  return r.stdout
+
+
+def main():
+  with TemporaryDirectory() as dir:
+    traces = {}
+    for format in ('marshal', 'indexed'):
+      for arg in ('0', '1'):
+        path = traces[format, arg] = os.path.join(dir, f'{format}-{arg}.cov')
+        coven('-record', 'bits', '-format', format, '-output', path, '--', 'inline_{}.py', arg)
+    for formats in (('marshal', 'marshal'), ('indexed', 'marshal'), ('marshal', 'indexed'), ('indexed', 'indexed')):
+      paths = [traces[formats[0], '0'], traces[formats[1], '1']]
+      for opts in ((), ('-jobs', '2'), ('-stream-mem', '0')):
+        summary = coven('-coalesce', *paths, *opts).splitlines()[-1]
+        print(*formats, *opts, summary.partition(': ')[2])
+    env = dict(os.environ, PYTHONPATH=root_dir)
+    r = subprocess.run([sys.executable, '-c', parallel_check, *traces.values()], env=env, stdout=subprocess.PIPE,
+      universal_newlines=True, check=True)
+    print(r.stdout, end='')
+
+
+if __name__ == '__main__': main()
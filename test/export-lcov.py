@@ -0,0 +1,28 @@
+# Test that LCOV branches identify the edges of each line: a partially covered line marks exactly its untraced edges,
+# and that the BRF and BRH totals count the BRDA records.
+
+import os
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+
+
+coven_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'coven.py')
+
+
+def main():
+  with TemporaryDirectory() as dir:
+    for arg in ('0', '1'):
+      path = os.path.join(dir, f'{arg}.lcov')
+      subprocess.run([sys.executable, coven_path, '-lcov', path, '--', 'basic_{}.py', arg],
+        stdout=subprocess.DEVNULL, check=True)
+      print(f'arg {arg}:')
+      with open(path) as f: records = f.read().splitlines()
+      for record in records:
+        if record.startswith(('BRDA:', 'BRF:', 'BRH:')): print(' ', record)
+      brda = [r.rpartition(',')[2] for r in records if r.startswith('BRDA:')]
+      counts = {r[:3]: int(r[4:]) for r in records if r.startswith(('BRF:', 'BRH:'))}
+      print('  BRF and BRH agree with BRDA:', counts == {'BRF': len(brda), 'BRH': brda.count('1')})
+
+
+if __name__ == '__main__': main()
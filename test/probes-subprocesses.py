@@ -0,0 +1,19 @@
+# Test that `-engine probes` rejects `-subprocesses`, rather than silently leaving the main code of children untraced.
+
+import os
+import subprocess
+import sys
+
+
+coven_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'coven.py')
+
+
+def main():
+  r = subprocess.run([sys.executable, coven_path, '-engine', 'probes', '-subprocesses', '--', 'subprocesses_{}.py', 'main'],
+    stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+  print('code:', r.returncode)
+  print(r.stderr.splitlines()[-1])
+  print('stdout:', repr(r.stdout))
+
+
+if __name__ == '__main__': main()
@@ -0,0 +1,20 @@
+# Test that a helper is saturated as soon as its bitmap is complete, within the activation that completes it.
+# The traced script runs in its own coven process, so that its debug output can be captured.
+
+import os
+import subprocess
+import sys
+
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+coven_path = os.path.join(test_dir, '..', 'coven.py')
+
+
+def main():
+  r = subprocess.run([sys.executable, coven_path, '-saturate', '-dbg', 'saturate', '--', 'saturate_{}.py', '12'],
+    cwd=test_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+  for line in r.stderr.splitlines():
+    if line.startswith('coven: saturated:'): print(line.replace(test_dir + os.sep, ''))
+
+
+if __name__ == '__main__': main()
@@ -0,0 +1,17 @@
+
+# Test that saturated code objects still report full coverage after tracing stops.
+
+from sys import argv
+
+
+def helper(arg):
+  if arg % 2: return 'odd'
+  return 'even'
+
+
+def top(arg):
+  for i in range(arg * 4): helper(i)
+  if arg > 1: return helper(arg)
+
+
+for a in argv[1]: top(int(a))
@@ -0,0 +1,36 @@
+# Test that an embedded Session restores the host's `threading` trace hook, and that sessions cannot overlap,
+# including probes sessions, which install no tracer.
+# The host runs in a plain interpreter, because a session cannot start under the tracer that runs this test.
+
+import os
+import subprocess
+import sys
+
+
+root_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+host = '''
+import threading
+import coven
+
+def host_hook(*args): return None
+threading.settrace(host_hook)
+
+for engine in ('settrace', 'probes'):
+  session = coven.Session(['fixtures'], engine=engine).start()
+  for other_engine in ('settrace', 'probes'):
+    try: coven.Session(['fixtures'], engine=other_engine).start()
+    except ValueError as e: print(engine, other_engine, e)
+    else: print(engine, other_engine, 'started a second session')
+  session.stop()
+  print(engine, 'thread hook restored:', threading._trace_hook is host_hook)
+'''
+
+
+def main():
+  env = dict(os.environ, PYTHONPATH=root_dir)
+  r = subprocess.run([sys.executable, '-c', host], env=env, stdout=subprocess.PIPE, universal_newlines=True, check=True)
+  print(r.stdout, end='')
+
+
+if __name__ == '__main__': main()
@@ -0,0 +1,32 @@
+
+# Test that forked children, multiprocessing workers and Python subprocesses are traced and coalesced.
+
+import os
+import subprocess
+import sys
+from multiprocessing import get_context
+
+
+def work(arg):
+  if arg == 'fork': return 'fork'
+  if arg == 'pool': return 'pool'
+  return 'other'
+
+
+def main(mode):
+  if mode == 'child':
+    work('child')
+    return
+  pid = os.fork()
+  if pid == 0:
+    work('fork')
+    sys.exit(0)
+  os.waitpid(pid, 0)
+  with get_context('spawn').Pool(1) as pool:
+    pool.map(work, ['pool'])
+    pool.close()
+    pool.join()
+  subprocess.run([sys.executable, __file__, 'child'], check=True)
+
+
+if __name__ == '__main__': main(sys.argv[1])
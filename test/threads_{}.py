@@ -0,0 +1,26 @@
+
+# Test that code run in threads and thread pool workers is traced.
+
+from concurrent.futures import ThreadPoolExecutor
+from sys import argv
+from threading import Thread
+
+
+def classify(arg):
+  if arg % 2: return 'odd'
+  return 'even'
+
+
+def run_threads(args):
+  threads = [Thread(target=classify, args=(a,)) for a in args]
+  for t in threads: t.start()
+  for t in threads: t.join()
+
+
+def run_pool(args):
+  with ThreadPoolExecutor(4) as pool:
+    return list(pool.map(classify, args))
+
+
+if argv[1] == 'thread': run_threads([1, 2])
+else: run_pool([3])